@@ -0,0 +1,69 @@
+type CacheEntry<T> = {
+  // Infinity while the request is still in flight
+  expires: number;
+  response: Promise<T>;
+};
+
+// JSON.stringify with sorted object keys, so requests which only differ in the
+// order of their keys get the same cache key
+export function stableStringify(value: unknown): string {
+  return JSON.stringify(value, (_key, element) => {
+    if (element === null || typeof element !== 'object' || Array.isArray(element)) {
+      return element;
+    }
+    return Object.keys(element)
+      .sort()
+      .reduce((sorted: Record<string, unknown>, key) => {
+        sorted[key] = element[key];
+        return sorted;
+      }, {});
+  });
+}
+
+export class RequestCache<T> {
+  private entries = new Map<string, CacheEntry<T>>();
+
+  constructor(
+    private maxSize: number,
+    private ttlMs: number
+  ) {}
+
+  // returns the response of a request with the same key if it is still in
+  // flight or finished less than ttlMs ago, otherwise sends a new request.
+  get(key: string, request: () => Promise<T>): Promise<T> {
+    const cached = this.entries.get(key);
+    if (cached !== undefined) {
+      this.entries.delete(key);
+      if (cached.expires > Date.now()) {
+        // re-insert to mark it as the most recently used entry
+        this.entries.set(key, cached);
+        return cached.response;
+      }
+    }
+
+    const entry: CacheEntry<T> = { expires: Infinity, response: request() };
+    this.entries.set(key, entry);
+    entry.response.then(
+      () => {
+        entry.expires = Date.now() + this.ttlMs;
+      },
+      () => {
+        // errors are not cached, the next query tries again
+        if (this.entries.get(key) === entry) {
+          this.entries.delete(key);
+        }
+      }
+    );
+    for (const oldest of this.entries.keys()) {
+      if (this.entries.size <= this.maxSize) {
+        break;
+      }
+      this.entries.delete(oldest);
+    }
+    return entry.response;
+  }
+
+  clear(): void {
+    this.entries.clear();
+  }
+}
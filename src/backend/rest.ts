@@ -19,9 +19,14 @@ import { lastValueFrom } from 'rxjs';
 import { Aggregation, GraphType, MetricFindQuery } from '../RequestSpec';
 import { AutocompleterEntry, CmkQuery } from '../types';
 import { createCmkContext, replaceVariables, toLiveStatusQuery, updateMetricTitles, updateQuery } from '../utils';
+import { RequestCache, stableStringify } from './cache';
 import { Backend, DatasourceOptions } from './types';
 import { validateRequestSpec } from './validate';
 
+// identical graph requests of a dashboard refresh are only sent once
+const GRAPH_CACHE_SIZE = 500;
+const GRAPH_CACHE_TTL_MS = 10000;
+
 type RestApiError = {
   detail: string;
   status: number;
@@ -96,9 +101,11 @@ type RestApiAutocompleteResponse = {
 };
 export default class RestApiBackend implements Backend {
   datasource: DatasourceOptions;
+  graphCache: RequestCache<FetchResponse<RestApiGraphResponse>>;
 
   constructor(datasource: DatasourceOptions) {
     this.datasource = datasource;
+    this.graphCache = new RequestCache(GRAPH_CACHE_SIZE, GRAPH_CACHE_TTL_MS);
   }
 
   async listSites(): Promise<MetricFindValue[]> {
@@ -314,11 +321,7 @@ export default class RestApiBackend implements Backend {
         // the rest-api does not accept an empty string for the site value, but a missing site key
         request.site = query.requestSpec.site;
       }
-      response = await this.api<RestApiGraphResponse>({
-        url: '/domain-types/metric/actions/get/invoke',
-        method: 'POST',
-        data: request,
-      });
+      response = await this.graphRequest('/domain-types/metric/actions/get/invoke', request);
     } else {
       // send request for commercial editions
       const request: RestApiFilterRequest = {
@@ -326,14 +329,12 @@ export default class RestApiBackend implements Backend {
         aggregation: query.requestSpec.aggregation,
         ...commonRequest,
       };
-      response = await this.api<RestApiGraphResponse>({
-        url: '/domain-types/metric/actions/filter/invoke',
-        method: 'POST',
-        data: request,
-      });
+      response = await this.graphRequest('/domain-types/metric/actions/filter/invoke', request);
     }
 
-    const { time_range, step, metrics } = response.data;
+    const { time_range, step } = response.data;
+    // the response may be shared with other queries, but the titles are changed per query
+    const metrics = response.data.metrics.map((metric) => ({ ...metric, data_points: [...metric.data_points] }));
 
     updateMetricTitles(metrics, query, scopedVars);
 
@@ -374,6 +375,21 @@ export default class RestApiBackend implements Backend {
     }
   }
 
+  async graphRequest(
+    url: string,
+    request: RestApiGetRequest | RestApiFilterRequest
+  ): Promise<FetchResponse<RestApiGraphResponse>> {
+    // variables are already replaced and the time range is truncated to
+    // seconds, so repeated panels and targets result in the same key
+    return this.graphCache.get(`${url} ${stableStringify(request)}`, () =>
+      this.api<RestApiGraphResponse>({
+        url,
+        method: 'POST',
+        data: request,
+      })
+    );
+  }
+
   async autocompleterRequest(data: unknown): Promise<AutocompleterEntry[]> {
     const { ident, params: parameters, value } = data as { ident: string; value: unknown; params: unknown };
 
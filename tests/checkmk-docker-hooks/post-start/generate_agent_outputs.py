@@ -0,0 +1,131 @@
+"""
+Tool to create agent outputs for many hosts, e.g. for load tests of the
+datasource against a site with thousands of hosts.
+
+* the outputs are derived from the localhost_grafana0/1 templates, the
+  Hostname of the check_mk section is replaced by a unique name per host
+* every host gets --services local checks with --metrics metrics each and
+  --labels host labels
+* all values are derived from --seed and the host name, so two runs with the
+  same arguments create the same outputs
+* the outputs are created one at a time and written to --output, which
+  defaults to the agent_output directory of the site
+
+post-configure-checkmk.py uses this module for --synthetic-hosts.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import time
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+HOME_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES = ["localhost_grafana0", "localhost_grafana1"]
+
+
+class Fixture(NamedTuple):
+    hosts: int
+    services: int = 20
+    metrics: int = 3
+    labels: int = 5
+    prefix: str = "synthetic-host-"
+    seed: str = "grafana-checkmk-datasource"
+
+
+def load_templates(names: list[str] = TEMPLATES) -> list[bytes]:
+    return [Path(HOME_DIR, name).read_bytes() for name in names]
+
+
+def host_names(fixture: Fixture) -> list[str]:
+    return [f"{fixture.prefix}{host:05d}" for host in range(fixture.hosts)]
+
+
+def local_checks(rng: random.Random, fixture: Fixture) -> Iterator[str]:
+    for service in range(fixture.services):
+        metrics = "|".join(
+            f"metric_{metric}={rng.random() * 100:.2f};80;90;0;100"
+            for metric in range(fixture.metrics)
+        )
+        yield f'0 "Synthetic service {service:03d}" {metrics or "-"} OK'
+
+
+def agent_output(template: bytes, host_name: str, fixture: Fixture) -> bytes:
+    rng = random.Random(f"{fixture.seed}/{host_name}")
+    labels = {
+        "cmk/device_type": "container",
+        **{
+            f"synthetic/label_{label}": f"value_{rng.randrange(10)}"
+            for label in range(fixture.labels)
+        },
+    }
+    output = re.sub(
+        rb"^Hostname: .*$",
+        f"Hostname: {host_name}".encode("utf-8"),
+        template,
+        count=1,
+        flags=re.MULTILINE,
+    )
+    # checkmk merges sections which occur more than once
+    extra = [
+        "<<<labels:sep(0)>>>",
+        json.dumps(labels, separators=(",", ":")),
+        "<<<local:sep(0)>>>",
+        *local_checks(rng, fixture),
+    ]
+    return output.rstrip(b"\n") + ("\n" + "\n".join(extra) + "\n").encode("utf-8")
+
+
+def agent_outputs(
+    fixture: Fixture, templates: list[bytes]
+) -> Iterator[tuple[str, bytes]]:
+    for i, host_name in enumerate(host_names(fixture)):
+        yield host_name, agent_output(templates[i % len(templates)], host_name, fixture)
+
+
+def parse() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Create agent outputs for many hosts from the test templates"
+    )
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--services", type=int, default=20, help="per host")
+    parser.add_argument("--metrics", type=int, default=3, help="per service")
+    parser.add_argument("--labels", type=int, default=5, help="per host")
+    parser.add_argument("--prefix", default="synthetic-host-")
+    parser.add_argument("--seed", default="grafana-checkmk-datasource")
+    parser.add_argument(
+        "--output",
+        default=os.path.expanduser("~/var/check_mk/agent_output"),
+        help="directory for the agent outputs (default: %(default)s)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    fixture = Fixture(
+        hosts=args.hosts,
+        services=args.services,
+        metrics=args.metrics,
+        labels=args.labels,
+        prefix=args.prefix,
+        seed=args.seed,
+    )
+    os.makedirs(args.output, exist_ok=True)
+    start = time.monotonic()
+    size = 0
+    for host_name, content in agent_outputs(fixture, load_templates()):
+        Path(args.output, host_name).write_bytes(content)
+        size += len(content)
+    duration = time.monotonic() - start
+    print(
+        f"[GAO] {fixture.hosts} agent outputs with {size / 1e6:.1f} MB"
+        f" in {duration:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,30 +5,65 @@
 
 """
 Tool to create data in rrd files.
-Paths are hard coded for usage inside of cmk docker container.
+Paths default to the ones inside of the cmk docker container.
 
 * using watchdog to wait for modification event to detect recent created rrd
-  files, but after the configuration is written to the rrd files.
+  files, but after the configuration is written to the rrd files. a file is
+  only processed after it did not change for --debounce milliseconds.
 * as no old data can be inserted into rrd files, the rrd files are then
-  recreated using the configuration of the original rrd files
-* then random data for the previous 5 hours is inserted
+  recreated using the configuration of the original rrd files. the empty
+  recreated file is kept as template for all files with the same layout, in a
+  directory shared by all workers which is removed at shutdown
+* then random data for the previous 5 hours (see --history and --step) is
+  inserted, many timesteps per rrdtool.update call (see --update-chunk)
 * different random data generator (random, static, sine) are used to generate
-  the data
-* an internal list of modified files makes sure files are only updated once
+  the data. if numpy is available, the values of all timesteps of a
+  datasource are generated at once with the shapes of rrd_samples.py,
+  otherwise one lambda per datasource is called for every timestep
+* an internal list of modified files makes sure files are only updated once.
+  it remembers the inode of the written file for the last --seen-size files,
+  so a file which is deleted and created again is processed again
+* files are processed by a pool of worker processes (see --jobs), each file is
+  cloned to its own temporary file next to it and then renamed over it
+* with --scan all rrd files which already exist are processed once at startup,
+  without --watch the tool exits afterwards
+* counters and timings are written to --stats-file every --stats-interval
+  seconds, logged on SIGUSR1 and at shutdown
 """
 
 
+import argparse
+import contextlib
+import hashlib
+import json
 import math
+import multiprocessing
 import os
 import random
 import re
+import shutil
+import signal
+import struct
+import tempfile
+import threading
 import time
-from collections import defaultdict
+from collections import Counter, defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import NamedTuple
 
 import rrdtool
 from watchdog.events import PatternMatchingEventHandler
 from watchdog.observers import Observer
 
+from rrd_samples import numpy, shape_values, update_lines, write_updates
+
+
+class Backfill(NamedTuple):
+    history: int = 5 * 60 * 60
+    step: int = 60
+    update_chunk: int = 500
+
 
 def random_random_function():
     choice = random.randint(0, 2)
@@ -44,8 +79,98 @@ def random_random_function():
     raise Exception()
 
 
-def clone(original_rrd, clone_rrd):
-    info = rrdtool.info(original_rrd)
+def samples_numpy(timestamps, metrics_count):
+    rng = numpy.random.default_rng(random.getrandbits(64))
+    t = numpy.asarray(timestamps, dtype=numpy.float64)
+    kinds = [random.choice(["static", "random", "sine"]) for _ in range(metrics_count)]
+    return update_lines(
+        t, [shape_values(kind, rng, t, timestamps.step) for kind in kinds]
+    )
+
+
+def samples_python(timestamps, metrics_count):
+    randoms = [random_random_function() for _ in range(metrics_count)]
+    return [f"{int(t)}:" + ":".join(str(r(t)) for r in randoms) for t in timestamps]
+
+
+def samples(timestamps, metrics_count):
+    """
+    returns one rrdtool update string "timestamp:value:value:..." per timestamp
+    of the range timestamps. the random module has to be seeded beforehand.
+    """
+    if numpy is not None:
+        return samples_numpy(timestamps, metrics_count)
+    return samples_python(timestamps, metrics_count)
+
+
+# see rrd_format.h: stat_head_t is followed by ds_cnt ds_def_t and rra_cnt
+# rra_def_t, which together define the layout. the live data comes after them.
+STAT_HEAD = struct.Struct("=4s5s7xdQQQ80x")
+DS_DEF_SIZE = 120
+RRA_DEF_SIZE = 120
+
+
+def read_layout(filename: str) -> tuple[int, int, bytes] | None:
+    """
+    cheap fingerprint of a rrd file: its size, its number of datasources and
+    all definitions in its header. returns None if the header can not be parsed.
+    """
+    with open(filename, "rb") as rrd:
+        head = rrd.read(STAT_HEAD.size)
+        if len(head) < STAT_HEAD.size:
+            return None
+        cookie, _version, _float_cookie, ds_cnt, rra_cnt, _pdp_step = STAT_HEAD.unpack(
+            head
+        )
+        if cookie != b"RRD\0" or ds_cnt > 1000 or rra_cnt > 1000:
+            return None
+        definitions = rrd.read(ds_cnt * DS_DEF_SIZE + rra_cnt * RRA_DEF_SIZE)
+    return os.path.getsize(filename), ds_cnt, head + definitions
+
+
+def template_path(template_dir: str, layout: tuple[int, int, bytes]) -> str:
+    return os.path.join(
+        template_dir, hashlib.sha256(repr(layout).encode()).hexdigest() + ".rrd"
+    )
+
+
+def store_template(template_dir: str, layout: tuple[int, int, bytes], empty_rrd: str):
+    # other workers may store the same template at the same time
+    fd, tmp = tempfile.mkstemp(dir=template_dir, suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(empty_rrd, tmp)
+    os.replace(tmp, template_path(template_dir, layout))
+
+
+@contextlib.contextmanager
+def timed(timings: dict[str, float], phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+
+def clone(original_rrd, clone_rrd, template_dir=None, timings=None):
+    """
+    without template_dir every clone is created with rrdtool, otherwise the
+    first clone of every layout is stored there and copied for later files
+    """
+    if timings is None:
+        timings = {}
+    layout = None
+    if template_dir is not None:
+        with timed(timings, "layout"):
+            layout = read_layout(original_rrd)
+    # templates are written atomically and only removed at shutdown
+    template = template_path(template_dir, layout) if layout is not None else None
+    if template is not None and os.path.exists(template):
+        with timed(timings, "copy"):
+            shutil.copyfile(template, clone_rrd)
+        return layout[1]
+
+    with timed(timings, "info"):
+        info = rrdtool.info(original_rrd)
 
     metrics = set()
     for key in info.keys():
@@ -55,34 +180,52 @@ def clone(original_rrd, clone_rrd):
             metrics.add(id)
     metrics_count = len(metrics)
 
-    rrdtool.create(
-        clone_rrd,
-        "--start",
-        "20220101",
-        "--step",
-        "60",
-        "--template",
-        original_rrd,
-    )
+    with timed(timings, "create"):
+        rrdtool.create(
+            clone_rrd,
+            "--start",
+            "20220101",
+            "--step",
+            "60",
+            "--template",
+            original_rrd,
+        )
+    if layout is not None:
+        store_template(template_dir, layout, clone_rrd)
 
     return metrics_count
 
 
-def modify_in_place(filename):
-    filename_clone = "/tmp/clone.rrd"
-    if os.path.exists(filename_clone):
-        os.unlink(filename_clone)
-    metrics_count = clone(filename, filename_clone)
+def modify_in_place(filename, backfill=Backfill(), template_dir=None):
+    """
+    returns the inode of the written file and the seconds spent per phase
+    """
+    timings: dict[str, float] = {}
+    # the clone has to be on the same filesystem for an atomic rename, and must
+    # not match the *.rrd pattern of the watchdog
+    fd, filename_clone = tempfile.mkstemp(
+        prefix=".grrd-", suffix=".tmp", dir=os.path.dirname(filename)
+    )
+    os.close(fd)
+    try:
+        metrics_count = clone(filename, filename_clone, template_dir, timings)
 
-    random.seed(filename)
+        random.seed(filename)
 
-    now = int(time.time())
-    randoms = [random_random_function() for _ in range(metrics_count)]
-    for t in range(now - 5 * 60 * 60, now, 60):
-        metrics = ":".join(str(r(t)) for r in randoms)
-        rrdtool.update(filename_clone, f"{int(t)}:{metrics}")
+        now = int(time.time())
+        with timed(timings, "generate"):
+            updates = samples(
+                range(now - backfill.history, now, backfill.step), metrics_count
+            )
+        with timed(timings, "update"):
+            write_updates(filename_clone, updates, backfill.update_chunk)
 
-    os.rename(filename_clone, filename)
+        with timed(timings, "rename"):
+            os.rename(filename_clone, filename)
+    except BaseException:
+        os.unlink(filename_clone)
+        raise
+    return os.stat(filename).st_ino, timings
 
     # with open("original.json", "w") as original:
     #     json.dump(rrdtool.info("Check_MK.rrd"), original, sort_keys=True, indent=4)
@@ -90,10 +233,246 @@ def modify_in_place(filename):
     #     json.dump(rrdtool.info("clone.rrd"), clone_fo, sort_keys=True, indent=4)
 
 
+class Stats:
+    def __init__(self):
+        self.counters: Counter[str] = Counter(
+            dict.fromkeys(
+                ["events", "coalesced", "duplicates", "submitted", "done", "failed"], 0
+            )
+        )
+        # phase -> [count, total seconds, max seconds]
+        self.phases: dict[str, list] = defaultdict(lambda: [0, 0.0, 0.0])
+        self.queue_depth = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def record(self, timings: dict[str, float]) -> None:
+        with self._lock:
+            for phase, seconds in timings.items():
+                entry = self.phases[phase]
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            uptime = time.monotonic() - self._started
+            return {
+                "uptime": uptime,
+                "queue_depth": self.queue_depth,
+                "files_per_second": self.counters["done"] / uptime if uptime else 0,
+                **self.counters,
+                "phases": {
+                    phase: {
+                        "count": count,
+                        "avg_ms": total / count * 1000,
+                        "max_ms": maximum * 1000,
+                        "total_s": total,
+                    }
+                    for phase, (count, total, maximum) in self.phases.items()
+                },
+            }
+
+    def log(self) -> None:
+        print(f"[GRRD] Stats {json.dumps(self.as_dict())}")
+
+    def write(self, filename: str) -> None:
+        with open(filename + ".tmp", "w") as stats_file:
+            json.dump(self.as_dict(), stats_file, indent=2)
+        os.replace(filename + ".tmp", filename)
+
+    def report(
+        self,
+        filename: str | None,
+        interval: float,
+        log_request: threading.Event,
+        stop: threading.Event,
+    ) -> None:
+        """
+        runs in its own thread: writes the stats to filename every interval
+        seconds and logs them whenever log_request is set. the SIGUSR1 handler
+        only sets the event, as it interrupts the main thread, which may hold
+        the lock at that moment.
+        """
+        next_write = time.monotonic() + interval
+        while True:
+            timeout = max(0.0, next_write - time.monotonic()) if filename else None
+            requested = log_request.wait(timeout)
+            if stop.is_set():
+                return
+            if requested:
+                log_request.clear()
+                self.log()
+            if filename and time.monotonic() >= next_write:
+                self.write(filename)
+                next_write += interval
+
+
+class Pool:
+    """
+    runs modify_in_place in worker processes. at most queue_size files are
+    pending at once, submit blocks until a slot is free. the workers share a
+    template directory, which is removed by shutdown.
+    """
+
+    def __init__(self, jobs: int, queue_size: int, backfill: Backfill, stats: Stats):
+        # the observer runs in threads, so do not fork the workers from it
+        self._executor = ProcessPoolExecutor(
+            jobs, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._backfill = backfill
+        self._template_dir = tempfile.mkdtemp(prefix="grrd-templates-")
+        self._stats = stats
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def submit(self, filename: str, on_done=None) -> None:
+        """
+        on_done is called with the filename and the inode of the written file,
+        or None if processing failed.
+        """
+        self._slots.acquire()
+        with self._idle:
+            self._pending += 1
+            self._stats.queue_depth = self._pending
+        self._stats.count("submitted")
+        future = self._executor.submit(
+            modify_in_place, filename, self._backfill, self._template_dir
+        )
+        future.add_done_callback(partial(self._done, filename, on_done))
+
+    def _done(self, filename, on_done, future):
+        self._slots.release()
+        inode = None
+        if (exc := future.exception()) is not None:
+            print(f"[GRRD] {filename} failed: {exc!r}")
+            self._stats.count("failed")
+        else:
+            inode, timings = future.result()
+            self._stats.record(timings)
+            self._stats.count("done")
+        if on_done is not None:
+            on_done(filename, inode)
+        with self._idle:
+            self._pending -= 1
+            self._stats.queue_depth = self._pending
+            self._idle.notify_all()
+
+    def wait(self) -> None:
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def shutdown(self) -> None:
+        # waits until all pending files are written
+        self._executor.shutdown(wait=True)
+        shutil.rmtree(self._template_dir, ignore_errors=True)
+
+
+class SeenFiles:
+    """
+    remembers the inode written for the most recently processed files. None
+    means the file is still being processed.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._inodes: OrderedDict[str, int | None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, filename: str) -> bool:
+        with self._lock:
+            if filename in self._inodes:
+                inode = self._inodes[filename]
+                self._inodes.move_to_end(filename)
+                try:
+                    if inode is None or os.stat(filename).st_ino == inode:
+                        return False
+                except FileNotFoundError:
+                    del self._inodes[filename]
+                    return False
+            self._inodes[filename] = None
+            while len(self._inodes) > self._maxsize:
+                self._inodes.popitem(last=False)
+            return True
+
+    def done(self, filename: str, inode: int | None) -> None:
+        with self._lock:
+            if inode is None:
+                # failed, try again on the next event
+                self._inodes.pop(filename, None)
+            elif filename in self._inodes:
+                self._inodes[filename] = inode
+
+    def forget(self, filename: str) -> None:
+        with self._lock:
+            self._inodes.pop(filename, None)
+
+    def __len__(self):
+        return len(self._inodes)
+
+
+class Debouncer:
+    """
+    calls callback(filename) once a filename was not touched for quiet seconds.
+    """
+
+    def __init__(self, quiet: float, callback, stats: Stats):
+        self._quiet = quiet
+        self._callback = callback
+        self._stats = stats
+        # insertion order is deadline order, touch moves a filename to the end
+        self._deadlines: OrderedDict[str, float] = OrderedDict()
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def touch(self, filename: str) -> None:
+        with self._changed:
+            if filename in self._deadlines:
+                self._stats.count("coalesced")
+            self._deadlines[filename] = time.monotonic() + self._quiet
+            self._deadlines.move_to_end(filename)
+            self._changed.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._changed:
+                if not self._deadlines:
+                    if self._stopped:
+                        return
+                    self._changed.wait()
+                    continue
+                filename, deadline = next(iter(self._deadlines.items()))
+                delay = deadline - time.monotonic()
+                if delay > 0 and not self._stopped:
+                    self._changed.wait(delay)
+                    continue
+                del self._deadlines[filename]
+            self._callback(filename)
+
+    def stop(self) -> None:
+        """
+        hands over all waiting filenames without waiting for the quiet period
+        """
+        with self._changed:
+            self._stopped = True
+            self._changed.notify()
+        self._thread.join()
+
+
 class Handler(PatternMatchingEventHandler):
-    def __init__(self, *arg, **kwargs):
+    def __init__(self, *arg, pool, seen_size, debounce, stats, **kwargs):
         super().__init__(*arg, **kwargs)
-        self.seen_filenames = set()
+        self.pool = pool
+        self.stats = stats
+        self.seen_filenames = SeenFiles(seen_size)
+        self.debouncer = Debouncer(debounce, self.process, stats) if debounce else None
 
     def on_modified(self, event):
         self._process(event)
@@ -101,16 +480,122 @@ class Handler(PatternMatchingEventHandler):
     def on_closed(self, event):
         self._process(event)
 
-    def _process (self, event):
-        filename = event.src_path
-        if filename in self.seen_filenames:
-            return
-        self.seen_filenames.add(filename)
+    def on_deleted(self, event):
+        self.seen_filenames.forget(event.src_path)
+
+    def _process(self, event):
+        self.stats.count("events")
+        if self.debouncer:
+            self.debouncer.touch(event.src_path)
+        else:
+            self.process(event.src_path)
+
+    def process(self, filename: str) -> bool:
+        # called from the observer or debouncer thread and for the startup scan
+        if not self.seen_filenames.claim(filename):
+            self.stats.count("duplicates")
+            return False
         print(f"[GRRD] {filename}")
-        modify_in_place(filename)
+        self.pool.submit(filename, self.seen_filenames.done)
+        return True
+
+    def stop(self) -> None:
+        if self.debouncer:
+            self.debouncer.stop()
+
+
+def scan(root: str):
+    directories = [root]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(".rrd") and entry.is_file():
+                    yield entry.path
+
+
+def parse() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fill new rrd files with random data")
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=Backfill().history,
+        help="seconds of data to generate before now (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--step",
+        type=int,
+        default=Backfill().step,
+        help="seconds between two generated samples (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--update-chunk",
+        type=int,
+        default=Backfill().update_chunk,
+        help="samples written per rrdtool.update call (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        help="maximum number of pending files (default: 4 * jobs)",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=int,
+        default=1000,
+        help="milliseconds a file has to be unchanged before it is processed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seen-size",
+        type=int,
+        default=100000,
+        help="number of processed files to remember (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="write counters and timings as JSON to this file",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=10,
+        help="seconds between two writes of --stats-file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--site",
+        default=os.environ.get("OMD_SITE", "cmk"),
+        help="checkmk site, used for the default of --rrd-dir (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rrd-dir",
+        help="directory with the rrd files (default: /omd/sites/SITE/var/check_mk/rrd)",
+    )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        help="process all existing rrd files once, then exit unless --watch is given",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="watch for new rrd files (default if --scan is not given)",
+    )
+    return parser.parse_args()
 
 
 def main():
+    args = parse()
+    backfill = Backfill(args.history, args.step, args.update_chunk)
+    rrd_dir = args.rrd_dir or f"/omd/sites/{args.site}/var/check_mk/rrd"
+    watch = args.watch or not args.scan
+
     # hooks are called sync, so we have to fork
     if os.environ.get("GRRD_FORK"):
         pid = os.fork()
@@ -119,21 +604,62 @@ def main():
             return
     # forking done
 
-    observer = Observer()
-    observer.schedule(
-        Handler(patterns=["*.rrd"], ignore_directories=True),
-        "/omd/sites/cmk/var/check_mk/rrd",
-        recursive=True,
+    # handle SIGTERM like Ctrl-C, so pending files are still written
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    stats = Stats()
+    log_stats = threading.Event()
+    stop_stats = threading.Event()
+    reporter = threading.Thread(
+        target=stats.report,
+        args=(args.stats_file, args.stats_interval, log_stats, stop_stats),
+        daemon=True,
     )
-    observer.start()
-    print("[GRRD] Watchdog started")
+    reporter.start()
+    signal.signal(signal.SIGUSR1, lambda _signum, _frame: log_stats.set())
+
+    pool = Pool(args.jobs, args.queue_size or 4 * args.jobs, backfill, stats)
+    handler = Handler(
+        patterns=["*.rrd"],
+        ignore_directories=True,
+        pool=pool,
+        seen_size=args.seen_size,
+        debounce=args.debounce / 1000,
+        stats=stats,
+    )
+
+    observer = Observer()
+    if watch:
+        # start watching before the scan, so no file created meanwhile is missed
+        observer.schedule(handler, rrd_dir, recursive=True)
+        observer.start()
+        print("[GRRD] Watchdog started")
     try:
-        while True:
+        if args.scan:
+            start = time.monotonic()
+            count = sum(handler.process(filename) for filename in scan(rrd_dir))
+            pool.wait()
+            duration = time.monotonic() - start
+            print(
+                f"[GRRD] Scanned {count} files in {duration:.1f}s"
+                f" ({count / duration if duration else 0:.1f} files/s)"
+            )
+        while watch:
             time.sleep(10)
     except KeyboardInterrupt:
         print("[GRRD] Graceful shutdown")
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if watch:
         observer.stop()
-    observer.join()
+        observer.join()
+    handler.stop()
+    pool.shutdown()
+
+    stop_stats.set()
+    log_stats.set()
+    reporter.join()
+    stats.log()
+    if args.stats_file:
+        stats.write(args.stats_file)
 
 
 if __name__ == "__main__":
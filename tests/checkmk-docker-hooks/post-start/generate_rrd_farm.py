@@ -0,0 +1,191 @@
+"""
+Tool to create a complete var/check_mk/rrd tree with random data.
+
+Other than generate_random_rrd_data.py this does not need a running site, so
+a data volume like in production can be created for load tests of the
+datasource:
+
+* for every one of --hosts hosts and --services services a rrd file with
+  --metrics datasources and the matching .info file are written to
+  <root>/<host>/<service>.rrd
+* --history seconds of data with one sample every --step seconds are inserted
+* the values of every file are generated at once with numpy, each datasource
+  gets one of the shapes given by --shapes
+* all data is derived from --seed, host and service name, so two runs with the
+  same arguments create the same data
+* hosts are distributed over --jobs worker processes
+"""
+
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import numpy
+import rrdtool
+
+from rrd_samples import DAY, SHAPES, shape_values, update_lines, write_updates
+
+
+class Farm(NamedTuple):
+    root: str
+    hosts: int
+    services: int
+    metrics: int
+    history: int
+    step: int
+    shapes: list[str]
+    seed: str
+    update_chunk: int
+    now: int
+
+
+def pnp_cleanup(name: str) -> str:
+    return name.replace(" ", "_").replace(":", "_").replace("/", "_").replace("\\", "_")
+
+
+def host_name(host: int) -> str:
+    return f"farm-host-{host:05d}"
+
+
+def service_name(service: int) -> str:
+    return f"Farm service {service:03d}"
+
+
+def rng_for(*parts: str) -> numpy.random.Generator:
+    digest = hashlib.sha256("/".join(parts).encode("utf-8")).digest()
+    return numpy.random.default_rng(int.from_bytes(digest[:16], "big"))
+
+
+def rrd_definitions(kinds: list[str], step: int) -> list[str]:
+    heartbeat = max(8460, 2 * step)
+    return [
+        f"DS:{i}:{'COUNTER' if kind == 'counter' else 'GAUGE'}:{heartbeat}:U:U"
+        for i, kind in enumerate(kinds, start=1)
+    ] + [
+        f"RRA:{cf}:0.5:{steps}:{rows}"
+        for cf in ["AVERAGE", "MIN", "MAX"]
+        for steps, rows in [(1, 2880), (5, 2880), (30, 4320), (360, 5840)]
+    ]
+
+
+def write_service(farm: Farm, host: str, service: str) -> int:
+    rng = rng_for(farm.seed, host, service)
+    kinds = [str(rng.choice(farm.shapes)) for _ in range(farm.metrics)]
+    start = farm.now - farm.history
+    t = numpy.arange(start, farm.now, farm.step, dtype=numpy.float64)
+    values = [shape_values(kind, rng, t, farm.step) for kind in kinds]
+
+    directory = os.path.join(farm.root, pnp_cleanup(host))
+    base = os.path.join(directory, pnp_cleanup(service))
+    rrdtool.create(
+        base + ".rrd",
+        "--start",
+        str(start - farm.step),
+        "--step",
+        str(farm.step),
+        *rrd_definitions(kinds, farm.step),
+    )
+    updates = update_lines(t, values)
+    write_updates(base + ".rrd", updates, farm.update_chunk)
+
+    with open(base + ".info", "w") as info:
+        info.write(f"HOST {host}\n")
+        info.write(f"SERVICE {service}\n")
+        info.write(f"METRICS {';'.join(f'metric_{i}' for i in range(farm.metrics))}\n")
+    return len(updates)
+
+
+def write_host(farm: Farm, host: int) -> int:
+    name = host_name(host)
+    os.makedirs(os.path.join(farm.root, pnp_cleanup(name)), exist_ok=True)
+    return sum(
+        write_service(farm, name, service_name(service))
+        for service in range(farm.services)
+    )
+
+
+def parse() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Create a var/check_mk/rrd tree with random data"
+    )
+    parser.add_argument("--root", default="var/check_mk/rrd", help="output directory")
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--services", type=int, default=10, help="per host")
+    parser.add_argument("--metrics", type=int, default=3, help="per service")
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=7 * DAY,
+        help="seconds of data to generate before now (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--step",
+        type=int,
+        default=60,
+        help="seconds between two samples (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--shapes",
+        default=",".join(SHAPES),
+        help="comma separated shapes to choose from (default: %(default)s)",
+    )
+    parser.add_argument("--seed", default="grafana-checkmk-datasource")
+    parser.add_argument(
+        "--now",
+        type=int,
+        help="end of the generated data, fix it for reproducible files (default: now)",
+    )
+    parser.add_argument(
+        "--update-chunk",
+        type=int,
+        default=500,
+        help="samples written per rrdtool.update call (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes (default: %(default)s)",
+    )
+    args = parser.parse_args()
+    if unknown := set(args.shapes.split(",")) - set(SHAPES):
+        parser.error(f"unknown shapes: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse()
+    now = args.now or int(time.time())
+    farm = Farm(
+        root=args.root,
+        hosts=args.hosts,
+        services=args.services,
+        metrics=args.metrics,
+        history=args.history,
+        step=args.step,
+        shapes=args.shapes.split(","),
+        seed=args.seed,
+        update_chunk=args.update_chunk,
+        now=now - now % args.step,
+    )
+
+    start = time.monotonic()
+    samples = 0
+    with ProcessPoolExecutor(args.jobs) as executor:
+        for samples_of_host in executor.map(
+            write_host, [farm] * farm.hosts, range(farm.hosts)
+        ):
+            samples += samples_of_host
+    duration = time.monotonic() - start
+    files = farm.hosts * farm.services
+    print(
+        f"[GRRD] {files} files with {samples * farm.metrics} values in {duration:.1f}s"
+        f" ({files / duration if duration else 0:.1f} files/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
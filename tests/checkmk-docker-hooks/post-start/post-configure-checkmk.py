@@ -4,19 +4,39 @@
 # conditions defined in the file COPYING, which is part of this source code package.
 
 import argparse
+import functools
+import hashlib
+import io
 import json
 import logging
 import os
 import re
 import subprocess
 import sys
+import tarfile
 import textwrap
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from http.client import HTTPConnection
 from pathlib import Path
-from typing import Dict, List, Mapping, NamedTuple, Sequence, TypedDict, Union
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Sequence,
+    TypeVar,
+    TypedDict,
+    Union,
+)
 
 import requests
+from requests.adapters import HTTPAdapter
+
+import generate_agent_outputs
 
 CMK_ADMIN = "cmkadmin"
 CMK_PASS = "abskjfdalkdhjbld"
@@ -27,6 +47,16 @@ HOME_DIR = os.path.dirname(os.path.abspath(__file__))
 HOSTNAME = ["localhost_grafana0", "localhost_grafana1"]
 
 TIMEOUT = 110
+# hosts per bulk-create and bulk-discovery request, and how many bulk-create
+# requests are sent at once
+CHUNK_SIZE = 500
+PARALLEL_CHUNKS = 4
+# overall limit for waiting on a discovery or activation job
+JOB_TIMEOUT = 1800
+# the services found by the discovery of a host, relative to the site home
+AUTOCHECKS_DIR = "var/check_mk/autochecks"
+
+T = TypeVar("T")
 
 
 class BulkHost(NamedTuple):
@@ -51,6 +81,31 @@ class Site(NamedTuple):
         ) + ["bash", "-c", command]
 
 
+class Backoff(NamedTuple):
+    first: float = 0.1
+    factor: float = 1.5
+    maximum: float = 2.0
+    timeout: float = JOB_TIMEOUT
+
+    def delays(self) -> Iterator[float]:
+        delay = self.first
+        while True:
+            yield delay
+            delay = min(delay * self.factor, self.maximum)
+
+
+class SyntheticFile(NamedTuple):
+    """
+    stands in for the Path of an agent output which is only created on upload
+    """
+
+    name: str
+    read_bytes: Callable[[], bytes]
+
+
+SourceFile = Union[Path, SyntheticFile]
+
+
 class HostResponse(TypedDict):
     # this is incomplete
     id: str
@@ -66,6 +121,114 @@ class CreateConfig(NamedTuple):
     source_destination: str
 
 
+def chunks(items: Sequence[T], size: int) -> Iterator[Sequence[T]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def describe_chunk(hosts: Sequence[str]) -> str:
+    if len(hosts) == 1:
+        return hosts[0]
+    return f"{hosts[0]} .. {hosts[-1]} ({len(hosts)} hosts)"
+
+
+def upload_files(
+    site: Site, destination: str, files: Iterable[tuple[str, bytes]]
+) -> int:
+    """
+    write the content of every (host_name, content) to destination formatted
+    with host_name. from site context the files are written directly, otherwise
+    all of them are sent as one tar stream to a single process of the site user.
+    """
+    if site.called_as_site_user:
+        count = 0
+        folders = set()
+        for host_name, content in files:
+            path = Path(os.path.expanduser(destination.format(host_name=host_name)))
+            if path.parent not in folders:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                folders.add(path.parent)
+            path.write_bytes(content)
+            count += 1
+        return count
+
+    # only the part before the first placeholder is the same for every file
+    folder = os.path.dirname(destination.split("{", 1)[0])
+    count = 0
+    with subprocess.Popen(
+        site.args_for_command(f"mkdir -p {folder} && tar -x -C {folder} -f -"),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+    ) as proc:
+        assert proc.stdin is not None
+        with proc.stdin, tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+            now = time.time()
+            for host_name, content in files:
+                info = tarfile.TarInfo(
+                    os.path.relpath(destination.format(host_name=host_name), folder)
+                )
+                info.size = len(content)
+                info.mode = 0o644
+                info.mtime = int(now)
+                tar.addfile(info, io.BytesIO(content))
+                count += 1
+    if proc.returncode != 0:
+        raise RuntimeError(f"uploading files failed with exit code {proc.returncode}")
+    return count
+
+
+def file_hashes(site: Site, destination: str, host_names: List[str]) -> Dict[str, str]:
+    """
+    returns the sha256 of the file of every host which already has one
+    """
+    if site.called_as_site_user:
+        hashes = {}
+        for host_name in host_names:
+            path = os.path.expanduser(destination.format(host_name=host_name))
+            try:
+                hashes[host_name] = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+            except FileNotFoundError:
+                pass
+        return hashes
+
+    folder = os.path.dirname(destination.split("{", 1)[0])
+    names = {
+        os.path.relpath(destination.format(host_name=host_name), folder): host_name
+        for host_name in host_names
+    }
+    output = subprocess.run(
+        site.args_for_command(
+            f"cd {folder} 2>/dev/null && find . -type f -exec sha256sum {{}} +"
+        ),
+        stdout=subprocess.PIPE,
+        check=False,
+        text=True,
+    ).stdout
+    hashes = {}
+    for line in output.splitlines():
+        digest, path = line.split("  ", 1)
+        if (host_name := names.get(os.path.normpath(path))) is not None:
+            hashes[host_name] = digest
+    return hashes
+
+
+def hosts_with_services(site: Site, host_names: List[str]) -> set[str]:
+    """
+    returns the hosts whose autochecks contain at least one discovered service.
+    an empty autochecks file is "[\n]", the entries are dicts.
+    """
+    output = subprocess.run(
+        site.args_for_command(
+            f"cd ~/{AUTOCHECKS_DIR} 2>/dev/null && grep -l -F '{{' -- *.mk"
+        ),
+        stdout=subprocess.PIPE,
+        check=False,
+        text=True,
+    ).stdout
+    discovered = {os.path.splitext(line)[0] for line in output.splitlines()}
+    return discovered & set(host_names)
+
+
 class Printer:
     RESET = "\033[0m"
     RED = 31
@@ -124,7 +287,7 @@ class Printer:
 
 def create_from(
     config: CreateConfig,
-    source_files: list[Path],
+    source_files: list[SourceFile],
     api: "API",
     site: Site,
     printer: Printer,
@@ -147,80 +310,204 @@ def create_from(
     existing_hosts = set([h["id"] for h in api.get_hosts(config.folder_name)])
 
     hosts_to_create: List[BulkHost] = []
-    all_hosts: List[str] = []
     for path in source_files:
         host_name = path.name
-        all_hosts.append(host_name)
         if host_name in existing_hosts:
             printer.success(printer.indent(f"host {host_name} already exists"))
             continue
-        hosts_to_create.append(
-            BulkHost(
-                host_name,
-                config.folder_name,
-                attributes={
-                    "tag_address_family": "no-ip",
-                    **config.host_attributes,
-                },
-            )
-        )
+        hosts_to_create.append(bulk_host(config, host_name))
+
+    provision(
+        config,
+        hosts_to_create,
+        source_files,
+        [path.name for path in source_files if path.name in existing_hosts],
+        api,
+        site,
+        printer,
+    )
 
-    if hosts_to_create:
-        printer.info(
-            printer.indent(
-                f"creating hosts: {', '.join(h.name for h in hosts_to_create)}"
-            )
-        )
-        api.bulk_create_hosts(hosts_to_create)
+    printer.headline("## activate changes")
+    api.activate_changes(printer)
 
-    printer.headline("## creating files")
 
-    printer.info(printer.indent("make sure folder exists"))
-    # not necessary for snmp walks, but does not hurt
-    folder = Path(config.source_destination).parent
-    with subprocess.Popen(
-        site.args_for_command(f"mkdir -p {folder}"),
-        stdin=subprocess.PIPE,
-        stdout=subprocess.DEVNULL,
-    ):
-        pass
+def reconcile_from(
+    config: CreateConfig,
+    source_files: list[SourceFile],
+    api: "API",
+    site: Site,
+    printer: Printer,
+) -> None:
+    """
+    like create_from, but only changes what differs from the current state of
+    the site: hosts which are missing are created, hosts which are not in
+    source_files are deleted, and only files with a different content are
+    uploaded and discovered again. hosts without discovered services are
+    discovered again too, e.g. if an earlier run failed after the upload.
+    """
+    printer.headline("## reconcile folder")
+    if api.get_folder(config.folder_name) is None:
+        printer.info(printer.indent(f"create folder: {config.folder_name}"))
+        api.create_folder(config.folder_name, config.folder_title)
+    else:
+        printer.success(printer.indent(f"folder {config.folder_name} already exists."))
 
-    for path in source_files:
-        host_name = path.name
-        printer.info(printer.indent(f"creating file for {host_name}"))
-        with subprocess.Popen(
-            site.args_for_command(
-                f"tee {config.source_destination.format(host_name=host_name)}"
-            ),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-        ) as proc:
-            proc.communicate(input=path.read_bytes())
+    rules = api.get_rules(config.rule_name, config.folder_name)
+    if any(rule["extensions"]["value_raw"] == config.rule_value for rule in rules):
+        printer.success(printer.indent(f"rule {config.rule_name} is up to date"))
+    else:
+        for rule in rules:
+            printer.info(printer.indent(f"delete outdated rule {rule['id']}"))
+            api.delete_rule(rule["id"])
+        printer.info(printer.indent(f"configure folder {config.folder_name}"))
+        api.create_rule(
+            name=config.rule_name,
+            value=config.rule_value,
+            folder=config.folder_name,
+        )
+
+    printer.headline("## reconcile hosts")
+    existing_hosts = set([h["id"] for h in api.get_hosts(config.folder_name)])
+    wanted_hosts = [path.name for path in source_files]
+    obsolete_hosts = sorted(existing_hosts - set(wanted_hosts))
+    if obsolete_hosts:
+        printer.info(printer.indent(f"deleting {len(obsolete_hosts)} hosts"))
+        api.bulk_delete_hosts(obsolete_hosts)
+    hosts_to_create = [
+        bulk_host(config, host_name)
+        for host_name in wanted_hosts
+        if host_name not in existing_hosts
+    ]
+
+    current_hashes = file_hashes(site, config.source_destination, wanted_hosts)
+    changed_files = [
+        path
+        for path in source_files
+        if current_hashes.get(path.name)
+        != hashlib.sha256(path.read_bytes()).hexdigest()
+    ]
+    changed_hosts = {path.name for path in changed_files}
+    discovered_hosts = hosts_with_services(site, wanted_hosts)
+    hosts_to_discover = [
+        host_name
+        for host_name in wanted_hosts
+        if host_name in existing_hosts
+        and (host_name in changed_hosts or host_name not in discovered_hosts)
+    ]
+    printer.info(
+        printer.indent(
+            f"{len(hosts_to_create)} hosts missing, "
+            f"{len(changed_files)} of {len(source_files)} files changed, "
+            f"{len(set(wanted_hosts) - discovered_hosts)} hosts without services"
+        )
+    )
 
-    printer.headline("## discover services")
-    api.bulk_discovery(all_hosts, printer)
+    provision(
+        config,
+        hosts_to_create,
+        changed_files,
+        hosts_to_discover,
+        api,
+        site,
+        printer,
+    )
 
     printer.headline("## activate changes")
     api.activate_changes(printer)
 
 
+def bulk_host(config: CreateConfig, host_name: str) -> BulkHost:
+    return BulkHost(
+        host_name,
+        config.folder_name,
+        attributes={
+            "tag_address_family": "no-ip",
+            **config.host_attributes,
+        },
+    )
+
+
+def provision(
+    config: CreateConfig,
+    hosts_to_create: List[BulkHost],
+    files: list[SourceFile],
+    existing_hosts_to_discover: List[str],
+    api: "API",
+    site: Site,
+    printer: Printer,
+) -> None:
+    """
+    create the hosts, upload the files and discover the created hosts as well
+    as the given existing ones
+    """
+    if api.pipeline:
+        # discovery starts before all hosts exist, so the files are needed first
+        upload_source_files(config, files, site, printer)
+        printer.headline("## creating hosts and discovering services")
+        api.create_and_discover(hosts_to_create, existing_hosts_to_discover, printer)
+        return
+
+    if hosts_to_create:
+        printer.info(printer.indent(f"creating {len(hosts_to_create)} hosts"))
+        api.bulk_create_hosts(hosts_to_create, printer)
+
+    upload_source_files(config, files, site, printer)
+
+    hosts_to_discover = [h.name for h in hosts_to_create] + existing_hosts_to_discover
+    if hosts_to_discover:
+        printer.headline("## discover services")
+        api.bulk_discovery(hosts_to_discover, printer)
+
+
+def upload_source_files(
+    config: CreateConfig, source_files: list[SourceFile], site: Site, printer: Printer
+) -> None:
+    printer.headline("## creating files")
+    start = time.monotonic()
+    count = upload_files(
+        site,
+        config.source_destination,
+        ((path.name, path.read_bytes()) for path in source_files),
+    )
+    printer.info(
+        printer.indent(f"created {count} files in {time.monotonic() - start:.1f}s")
+    )
+
+
 class API:
-    def __init__(self, site: Site):
+    def __init__(
+        self,
+        site: Site,
+        *,
+        chunk_size: int = CHUNK_SIZE,
+        parallel_chunks: int = PARALLEL_CHUNKS,
+        backoff: Backoff = Backoff(),
+        pipeline: bool = False,
+    ):
         username = CMK_ADMIN
         password = CMK_PASS
         port = CMK_PORT
         self._base_url = f"http://localhost:{port}/{site.name}/check_mk/api/v1"
+        self._chunk_size = chunk_size
+        self._parallel_chunks = parallel_chunks
+        self._backoff = backoff
+        self.pipeline = pipeline
         self._session = requests.session()
+        # one kept-alive connection for every chunk in flight
+        self._session.mount("http://", HTTPAdapter(pool_maxsize=parallel_chunks))
         self._session.headers["Authorization"] = f"Bearer {username} {password}"
         self._session.headers["Accept"] = "application/json"
         self._version = self.version()
 
+    @functools.cached_property
     def _version_le_230(self) -> bool:
         return bool(re.match("^(2.3.0|2.2.0|2.1.0|2.0.0)", self._version))
 
+    @functools.cached_property
     def _version_le_220(self) -> bool:
         return bool(re.match("^(2.2.0|2.1.0|2.0.0)", self._version))
 
+    @functools.cached_property
     def _version_le_210(self) -> bool:
         return bool(re.match("^(2.1.0|2.0.0)", self._version))
 
@@ -298,6 +585,24 @@ class API:
     def delete_automation_user(self, username: str) -> None:
         self._delete(f"/objects/user_config/{username}")
 
+    def get_user(self, username: str) -> Union[Dict[str, str], None]:
+        resp = self._get(f"/objects/user_config/{username}")
+        if resp.status_code == requests.codes.NOT_FOUND:
+            return None
+        resp.raise_for_status()
+        return resp.json()
+
+    def can_login(self, username: str, secret: str) -> bool:
+        resp = requests.get(
+            f"{self._base_url}/version",
+            headers={
+                "Authorization": f"Bearer {username} {secret}",
+                "Accept": "application/json",
+            },
+            timeout=TIMEOUT,
+        )
+        return resp.status_code == requests.codes.ok
+
     def create_folder(self, folder_name: str, folder_title: str) -> Dict[str, str]:
         return self._post(
             "/domain-types/folder_config/collections/all",
@@ -339,11 +644,31 @@ class API:
             },
         ).json()
 
+    def get_rules(self, name: str, folder: str) -> List[Dict]:
+        resp = self._get(f"/domain-types/rule/collections/all?ruleset_name={name}")
+        resp.raise_for_status()
+        # the folder is reported as /grafana or ~grafana depending on the version
+        return [
+            rule
+            for rule in resp.json()["value"]
+            if rule["extensions"]["folder"].lstrip("/~") == folder
+        ]
+
+    def delete_rule(self, rule_id: str) -> None:
+        self._delete(f"/objects/rule/{rule_id}")
+
+    def bulk_delete_hosts(self, hosts: List[str]) -> None:
+        for host_chunk in chunks(hosts, self._chunk_size):
+            self._post(
+                "/domain-types/host_config/actions/bulk-delete/invoke",
+                {"entries": list(host_chunk)},
+            )
+
     def get_hosts(self, folder_name: str) -> list[HostResponse]:
         resp = self._get(f"/objects/folder_config/~{folder_name}/collections/hosts")
         return resp.json()["value"]
 
-    def bulk_create_hosts(self, hosts: List[BulkHost]) -> None:
+    def _bulk_create_chunk(self, hosts: Sequence[BulkHost]) -> object:
         return self._post(
             "/domain-types/host_config/actions/bulk-create/invoke?bake_agent=false",
             {
@@ -358,14 +683,138 @@ class API:
             },
         ).json()
 
+    def bulk_create_hosts(self, hosts: List[BulkHost], printer: Printer) -> None:
+        """
+        create the hosts in chunks of chunk_size, with up to parallel_chunks
+        requests in flight. a failed chunk does not stop the others, all
+        failures are reported at the end.
+        """
+        host_chunks = list(chunks(hosts, self._chunk_size))
+        failed = 0
+        with ThreadPoolExecutor(self._parallel_chunks) as executor:
+            # map would submit all chunks at once and keep their responses,
+            # so only keep parallel_chunks futures around
+            pending: List[tuple[Sequence[BulkHost], Future]] = []
+            for host_chunk in host_chunks:
+                pending.append(
+                    (host_chunk, executor.submit(self._bulk_create_chunk, host_chunk))
+                )
+                if len(pending) >= self._parallel_chunks:
+                    failed += self._report_chunk(*pending.pop(0), printer)
+            for host_chunk, future in pending:
+                failed += self._report_chunk(host_chunk, future, printer)
+        if failed:
+            raise RuntimeError(
+                f"{failed} of {len(host_chunks)} bulk-create chunks failed"
+            )
+
+    @staticmethod
+    def _report_chunk(
+        hosts: Sequence[BulkHost], future: Future, printer: Printer
+    ) -> int:
+        description = describe_chunk([h.name for h in hosts])
+        try:
+            future.result()
+        except Exception as e:
+            printer.error(printer.indent(f"creating {description} failed: {e}"))
+            return 1
+        printer.info(printer.indent(f"created {description}"))
+        return 0
+
     def bulk_discovery(self, hosts: List[str], printer: Printer) -> None:
+        """
+        discover the hosts in chunks of chunk_size. checkmk runs only one bulk
+        discovery job at a time, so the chunks are sent one after the other.
+        """
+        self._create_and_discover(
+            [([], list(host_chunk)) for host_chunk in chunks(hosts, self._chunk_size)],
+            printer,
+        )
+
+    def create_and_discover(
+        self, hosts: List[BulkHost], existing_hosts: List[str], printer: Printer
+    ) -> None:
+        """
+        create the hosts chunk by chunk, and discover each chunk while the next
+        one is created. existing hosts are discovered while the first chunk is
+        created.
+        """
+        self._create_and_discover(
+            [
+                ([], list(host_chunk))
+                for host_chunk in chunks(existing_hosts, self._chunk_size)
+            ]
+            + [
+                (host_chunk, [h.name for h in host_chunk])
+                for host_chunk in chunks(hosts, self._chunk_size)
+            ],
+            printer,
+        )
+
+    def _create_and_discover(
+        self, steps: List[tuple[Sequence[BulkHost], List[str]]], printer: Printer
+    ) -> None:
+        failed = 0
+        # the job of the previous chunk, it runs while the next chunk is created
+        running: tuple[List[str], str | None] | None = None
+        for to_create, to_discover in steps:
+            if to_create:
+                try:
+                    self._bulk_create_chunk(to_create)
+                    printer.info(
+                        printer.indent(f"created {describe_chunk(to_discover)}")
+                    )
+                except (requests.RequestException, RuntimeError) as e:
+                    printer.error(
+                        printer.indent(
+                            f"creating {describe_chunk(to_discover)} failed: {e}"
+                        )
+                    )
+                    failed += 1
+                    continue
+            if running is not None:
+                failed += self._finish_discovery(*running, printer)
+            try:
+                printer.info(printer.indent(f"discover {describe_chunk(to_discover)}"))
+                running = (to_discover, self._start_discovery(to_discover, printer))
+            except (requests.RequestException, RuntimeError) as e:
+                printer.error(
+                    printer.indent(
+                        f"discovery of {describe_chunk(to_discover)} failed: {e}"
+                    )
+                )
+                failed += 1
+                running = None
+        if running is not None:
+            failed += self._finish_discovery(*running, printer)
+        if failed:
+            raise RuntimeError(f"{failed} of {len(steps)} chunks failed")
+
+    def _finish_discovery(
+        self, hosts: List[str], link: str | None, printer: Printer
+    ) -> int:
+        if link is None:
+            return 0
+        try:
+            self._wait_for_discovery(link, printer)
+        except (requests.RequestException, RuntimeError, TimeoutError) as e:
+            printer.error(
+                printer.indent(f"discovery of {describe_chunk(hosts)} failed: {e}")
+            )
+            return 1
+        return 0
+
+    def _start_discovery(self, hosts: List[str], printer: Printer) -> str | None:
+        """
+        returns the link of the discovery job if it is still running
+        """
         request: dict[str, bool | int | list[str] | str | dict[str, bool]] = {
             "hostnames": hosts,
             "do_full_scan": True,
             "bulk_size": 20,
             "ignore_errors": True,
         }
-        if self._version_le_220():
+        if self._version_le_220:
             request.update({"mode": "refresh"})
         else:
             request.update(
@@ -382,35 +831,55 @@ class API:
             "/domain-types/discovery_run/actions/bulk-discovery-start/invoke", request
         ).json()
         printer.info(printer.indent(result["title"]))
-        if result["extensions"]["active"]:
-            link = self._get_href_from_links(result["links"], "self")
-            while True:
-                result = self._get(link).json()
-
-                logs_progress = (
-                    result["extensions"]["logs"]["progress"]
-                    if self._version_le_230()
-                    else result["extensions"]["status"]["log_info"]["JobProgressUpdate"]
-                )
-                printer.info(printer.indent("\n".join(logs_progress)))
-
-                logs_result = (
-                    result["extensions"]["logs"]["result"]
-                    if self._version_le_230()
-                    else result["extensions"]["status"]["log_info"]["JobResult"]
-                )
+        if not result["extensions"]["active"]:
+            return None
+        return self._get_href_from_links(result["links"], "self")
+
+    def _wait_for_discovery(self, link: str, printer: Printer) -> None:
+        # the logs grow while the job runs, only print the new lines
+        printed = {"progress": 0, "result": 0}
+
+        def print_new(
+            kind: str, lines: List[str], print_lines: Callable[[str], None]
+        ) -> None:
+            if len(lines) > printed[kind]:
+                print_lines(printer.indent("\n".join(lines[printed[kind] :])))
+                printed[kind] = len(lines)
+
+        def finished(result: dict) -> bool:
+            if self._version_le_230:
+                logs = result["extensions"]["logs"]
+                logs_progress, logs_result = logs["progress"], logs["result"]
+                state = result["extensions"]["state"]
+            else:
+                status = result["extensions"]["status"]
+                logs_progress = status["log_info"]["JobProgressUpdate"]
+                logs_result = status["log_info"]["JobResult"]
+                state = status["state"]
+            print_new("progress", logs_progress, printer.info)
+            print_new("result", logs_result, printer.print)
+            return state == "finished"
 
-                if logs_result:
-                    printer.print(printer.indent("\n".join(logs_result)))
+        self._wait_for_job(link, finished)
 
-                state = (
-                    result["extensions"]["state"]
-                    if self._version_le_230()
-                    else result["extensions"]["status"]["state"]
+    def _wait_for_job(self, link: str, finished: Callable[[dict], bool]) -> dict:
+        """
+        polls the job until finished returns True. the first polls are quick,
+        then the interval grows up to the maximum of the backoff.
+        """
+        deadline = time.monotonic() + self._backoff.timeout
+        for delay in self._backoff.delays():
+            resp = self._get(link)
+            resp.raise_for_status()
+            result = resp.json()
+            if finished(result):
+                return result
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(
+                    f"job {link} did not finish within {self._backoff.timeout}s"
                 )
-                if state == "finished":
-                    break
-                time.sleep(1)
+            time.sleep(delay)
+        raise AssertionError("delays() is endless")
 
     def activate_changes(self, printer: Printer) -> None:
         result = self._post(
@@ -430,23 +899,23 @@ class API:
             return
         result.raise_for_status()
         link = self._get_href_from_links(result.json()["links"], "self")
-        while True:
-            result = self._get(link)
-            result.raise_for_status()
-            data = result.json()
+        last_title = None
+
+        def finished(data: dict) -> bool:
+            nonlocal last_title
             title = printer.indent(data["title"])
-            printer.info(title)
-            if self._version_le_210():
-                if title.endswith("has completed."):
-                    break
-            else:
-                if not data["extensions"]["is_running"]:
-                    for change in data["extensions"]["changes"]:
-                        printer.print(
-                            printer.indent(f"{change['user_id']} {change['text']}")
-                        )
-                    break
-            time.sleep(1)
+            if title != last_title:
+                printer.info(title)
+                last_title = title
+            if self._version_le_210:
+                return title.endswith("has completed.")
+            if data["extensions"]["is_running"]:
+                return False
+            for change in data["extensions"]["changes"]:
+                printer.print(printer.indent(f"{change['user_id']} {change['text']}"))
+            return True
+
+        self._wait_for_job(link, finished)
 
 
 def parse() -> tuple[argparse.ArgumentParser, argparse.Namespace]:
@@ -462,6 +931,59 @@ def parse() -> tuple[argparse.ArgumentParser, argparse.Namespace]:
         default=[0],
         help="more verbose",
     )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="hosts per bulk-create and bulk-discovery request (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--parallel-chunks",
+        type=int,
+        default=PARALLEL_CHUNKS,
+        help="bulk-create requests in flight at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--job-timeout",
+        type=float,
+        default=JOB_TIMEOUT,
+        help="seconds to wait for a discovery or activation job (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="discover every chunk of hosts while the next one is created",
+    )
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="only change what differs from the current state of the site, "
+        "instead of deleting and recreating the folder and the automation user",
+    )
+    parser.add_argument(
+        "--synthetic-hosts",
+        type=int,
+        default=0,
+        help="additional hosts with agent outputs derived from the templates",
+    )
+    parser.add_argument(
+        "--synthetic-services",
+        type=int,
+        default=generate_agent_outputs.Fixture(0).services,
+        help="services per synthetic host (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--synthetic-metrics",
+        type=int,
+        default=generate_agent_outputs.Fixture(0).metrics,
+        help="metrics per service of a synthetic host (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--synthetic-labels",
+        type=int,
+        default=generate_agent_outputs.Fixture(0).labels,
+        help="labels per synthetic host (default: %(default)s)",
+    )
     subparsers = parser.add_subparsers()
 
     args = parser.parse_args()
@@ -469,6 +991,26 @@ def parse() -> tuple[argparse.ArgumentParser, argparse.Namespace]:
     return parser, args
 
 
+def synthetic_files(fixture: generate_agent_outputs.Fixture) -> list[SyntheticFile]:
+    """
+    the agent outputs are only created when they are uploaded or hashed, so
+    they never have to be kept in memory at once
+    """
+    templates = generate_agent_outputs.load_templates()
+    return [
+        SyntheticFile(
+            host_name,
+            functools.partial(
+                generate_agent_outputs.agent_output,
+                templates[i % len(templates)],
+                host_name,
+                fixture,
+            ),
+        )
+        for i, host_name in enumerate(generate_agent_outputs.host_names(fixture))
+    ]
+
+
 def create_automation_user(username: str, password: str, api: API, printer: Printer):
     printer.headline("## automation user")
 
@@ -482,6 +1024,17 @@ def create_automation_user(username: str, password: str, api: API, printer: Prin
     api.activate_changes(printer)
 
 
+def reconcile_automation_user(
+    username: str, password: str, api: API, printer: Printer
+) -> None:
+    # the secret can not be read back, so check it by logging in with it
+    if api.get_user(username) is not None and api.can_login(username, password):
+        printer.headline("## automation user")
+        printer.success(printer.indent(f"automation user {username} is up to date"))
+        return
+    create_automation_user(username, password, api, printer)
+
+
 def main() -> None:
     parser, args = parse()
 
@@ -495,9 +1048,28 @@ def main() -> None:
 
     printer = Printer(level)
 
-    source_files = [Path(HOME_DIR + "/" + hostname) for hostname in HOSTNAME]
+    source_files: list[SourceFile] = [
+        Path(HOME_DIR + "/" + hostname) for hostname in HOSTNAME
+    ]
+    if args.synthetic_hosts:
+        source_files.extend(
+            synthetic_files(
+                generate_agent_outputs.Fixture(
+                    hosts=args.synthetic_hosts,
+                    services=args.synthetic_services,
+                    metrics=args.synthetic_metrics,
+                    labels=args.synthetic_labels,
+                )
+            )
+        )
     site = Site(CMK_SITE, True)
-    api = API(site)
+    api = API(
+        site,
+        chunk_size=args.chunk_size,
+        parallel_chunks=args.parallel_chunks,
+        backoff=Backoff(timeout=args.job_timeout),
+        pipeline=args.pipeline,
+    )
 
     create_config = CreateConfig(
         folder_name="grafana",
@@ -511,6 +1083,11 @@ def main() -> None:
         source_destination="~/var/check_mk/agent_output/{host_name}",
     )
 
+    if args.reconcile:
+        reconcile_from(create_config, source_files, api, site, printer)
+        reconcile_automation_user(CMK_AUITOMATION_USER, CMK_PASS, api, printer)
+        return
+
     api.delete_folder(create_config.folder_name)
 
     create_from(create_config, source_files, api, site, printer)
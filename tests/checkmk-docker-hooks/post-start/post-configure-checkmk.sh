@@ -4,9 +4,9 @@
 su - cmk -c "/usr/bin/env bash" << __EOF__
 
 # Watch for new rrd files and fill them with random data
-python3 -m pip install watchdog
+python3 -m pip install watchdog numpy
 export GRRD_FORK=1
-python3 -u /docker-entrypoint.d/post-start/generate_random_rrd_data.py
+python3 -u /docker-entrypoint.d/post-start/generate_random_rrd_data.py --scan --watch
 
 # Wait until Checkmk API responds our requests
 until curl -f -s -u cmkadmin:abskjfdalkdhjbld http://127.0.0.1:5000/cmk/check_mk/api/1.0/version
@@ -16,5 +16,5 @@ do
 done
 
 # Create hosts, discover services, and create automation user
-python3 -u /docker-entrypoint.d/post-start/post-configure-checkmk.py
+python3 -u /docker-entrypoint.d/post-start/post-configure-checkmk.py --reconcile
 __EOF__
@@ -0,0 +1,75 @@
+"""
+Shapes of the generated values and writing them to rrd files, shared by
+generate_random_rrd_data.py and generate_rrd_farm.py.
+
+The shapes need numpy, callers without numpy have to check for it.
+"""
+
+import rrdtool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SHAPES = [
+    "static",
+    "random",
+    "sine",
+    "random_walk",
+    "spikes",
+    "daily",
+    "counter",
+]
+DAY = 24 * 60 * 60
+COUNTER_WRAP = 2**32
+
+
+def shape_values(shape: str, rng, t, step: int):
+    """
+    returns one value per timestamp in t for the given shape. rng is a
+    numpy.random.Generator, t a numpy array of timestamps.
+    """
+    if shape == "static":
+        return numpy.full(len(t), float(rng.integers(0, 500)))
+    if shape == "random":
+        return rng.random(len(t)) * 100
+    if shape == "sine":
+        offset, frequency = rng.random(2)
+        return numpy.sin(offset + t / (1000.0 * (1 + frequency))) * 100
+    if shape == "random_walk":
+        return numpy.abs(rng.normal(0, 2, len(t)).cumsum() + rng.random() * 100)
+    if shape == "spikes":
+        base = rng.random(len(t)) * 10
+        spikes = rng.random(len(t)) < 0.01
+        base[spikes] += rng.random(int(spikes.sum())) * 1000
+        return base
+    if shape == "daily":
+        phase = rng.random() * 2 * numpy.pi
+        level = 20 + rng.random() * 50
+        noise = rng.normal(0, level / 10, len(t))
+        return numpy.maximum(
+            level + level * 0.8 * numpy.sin(2 * numpy.pi * t / DAY + phase) + noise, 0
+        )
+    if shape == "counter":
+        # bytes per step of a busy interface, wrapping like a 32 bit counter
+        rate = rng.random() * 1e6 * step
+        start = rng.integers(0, COUNTER_WRAP)
+        increments = rng.poisson(rate, len(t)).astype(numpy.float64)
+        return numpy.mod(start + increments.cumsum(), COUNTER_WRAP)
+    raise ValueError(f"unknown shape {shape}")
+
+
+def update_lines(t, columns) -> list[str]:
+    """
+    returns one rrdtool update string "timestamp:value:value:..." per timestamp
+    in t, with one value of every column
+    """
+    line = "%d" + ":%.10g" * len(columns)
+    return [line % tuple(row) for row in numpy.column_stack([t, *columns]).tolist()]
+
+
+def write_updates(filename: str, updates: list[str], chunk: int) -> None:
+    # every call opens, locks and closes the file, so send many samples at once
+    for i in range(0, len(updates), chunk):
+        rrdtool.update(filename, *updates[i : i + chunk])
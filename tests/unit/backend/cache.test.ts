@@ -0,0 +1,120 @@
+import { TimeRange, dateTime } from '@grafana/data';
+import { FetchResponse } from '@grafana/runtime';
+import { expect } from '@jest/globals';
+
+import { RequestCache, stableStringify } from '../../../src/backend/cache';
+import RestApiBackend from '../../../src/backend/rest';
+import { DatasourceOptions } from '../../../src/backend/types';
+import { EditionFamily } from '../../../src/edition';
+import { CmkQuery } from '../../../src/types';
+
+describe('stableStringify', () => {
+  it('ignores the order of keys', () => {
+    expect(stableStringify({ b: 1, a: { d: [2, { f: 3, e: 4 }], c: null } })).toBe(
+      stableStringify({ a: { c: null, d: [2, { e: 4, f: 3 }] }, b: 1 })
+    );
+  });
+  it('keeps the order of arrays', () => {
+    expect(stableStringify([1, 2])).not.toBe(stableStringify([2, 1]));
+  });
+});
+
+describe('RequestCache', () => {
+  beforeEach(() => {
+    jest.useFakeTimers();
+  });
+  afterEach(() => {
+    jest.useRealTimers();
+  });
+
+  it('coalesces requests in flight', async () => {
+    const cache = new RequestCache<string>(10, 1000);
+    const request = jest.fn(() => Promise.resolve('response'));
+    const responses = await Promise.all([cache.get('key', request), cache.get('key', request)]);
+    expect(responses).toStrictEqual(['response', 'response']);
+    expect(request).toHaveBeenCalledTimes(1);
+  });
+
+  it('sends the request again after the ttl', async () => {
+    const cache = new RequestCache<string>(10, 1000);
+    const request = jest.fn(() => Promise.resolve('response'));
+    await cache.get('key', request);
+    jest.advanceTimersByTime(500);
+    await cache.get('key', request);
+    expect(request).toHaveBeenCalledTimes(1);
+    jest.advanceTimersByTime(1000);
+    await cache.get('key', request);
+    expect(request).toHaveBeenCalledTimes(2);
+  });
+
+  it('evicts the least recently used entry', async () => {
+    const cache = new RequestCache<string>(2, 1000);
+    const sent: string[] = [];
+    const request = (key: string) => () => {
+      sent.push(key);
+      return Promise.resolve(key);
+    };
+    for (const key of ['a', 'b', 'a', 'c', 'a', 'b']) {
+      await cache.get(key, request(key));
+    }
+    // c evicted b, as a was used more recently
+    expect(sent).toStrictEqual(['a', 'b', 'c', 'b']);
+  });
+
+  it('does not cache errors', async () => {
+    const cache = new RequestCache<string>(10, 1000);
+    const failing = jest.fn(() => Promise.reject(new Error('failed')));
+    await expect(cache.get('key', failing)).rejects.toThrow('failed');
+    const request = jest.fn(() => Promise.resolve('response'));
+    await expect(cache.get('key', request)).resolves.toBe('response');
+    expect(request).toHaveBeenCalledTimes(1);
+  });
+});
+
+describe('RestApiBackend graph requests', () => {
+  const graphResponse = {
+    time_range: { start: '2024-01-01T00:00:00Z', end: '2024-01-01T00:01:00Z' },
+    step: 60,
+    metrics: [{ color: '#ff0000', data_points: [1, 2], line_type: 'line', title: 'CPU load' }],
+  };
+
+  const query = (refId: string, host_name: string): CmkQuery => ({
+    refId,
+    requestSpec: {
+      graph_type: 'single_metric',
+      graph: 'load1',
+      site: 'cmk',
+      host_name,
+      service: 'CPU load',
+    },
+  });
+
+  const range = (): TimeRange => {
+    const from = dateTime('2024-01-01T00:00:00.123Z');
+    const to = dateTime('2024-01-01T00:01:00.456Z');
+    return { from, to, raw: { from, to } };
+  };
+
+  const mockDatasource = {
+    getEdition: () => 'RAW',
+    getUrl: () => 'http://localhost',
+    getUsername: () => 'automation',
+    getEditionFamily: () => EditionFamily.COMMUNITY,
+  } as DatasourceOptions;
+
+  it('sends identical requests only once', async () => {
+    const backend = new RestApiBackend(mockDatasource);
+    const api = jest
+      .spyOn(backend, 'api')
+      .mockImplementation(() => Promise.resolve({ data: graphResponse } as FetchResponse<never>));
+
+    const frames = await Promise.all([
+      backend.getSingleGraph(range(), query('A', 'host1')),
+      backend.getSingleGraph(range(), query('B', 'host1')),
+      backend.getSingleGraph(range(), query('C', 'host2')),
+    ]);
+
+    expect(api).toHaveBeenCalledTimes(2);
+    expect(frames.map((frame) => frame.refId)).toStrictEqual(['A', 'B', 'C']);
+  });
+});
@@ -1,11 +1,30 @@
 #!/usr/bin/env python3
 
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlsplit
 import argparse
+import contextlib
+import copy
+import gzip
+import hashlib
+import heapq
 import json
-import pprint
+import os
+import queue
 import sqlite3
-import urllib.request as rq
+import sys
+import threading
+import time
+
+RECIPE_CACHE_SIZE = 10000
+BATCH_SIZE = 500
+CONVERTER_VERSION = "1"
+LEDGER_TABLE = "checkmk_converter_ledger"
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+SLOWEST_DASHBOARDS = 10
 
 
 def cli_options():
@@ -18,6 +37,75 @@ def cli_options():
     parser.add_argument(
         "-n", "--datasource-new", help="Name of the NEW Grafana Connector Version 2.x"
     )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=RECIPE_CACHE_SIZE,
+        help="Maximum number of graph recipes kept in memory (default: %(default)s)."
+        " --workers raises it to the number of services to prefetch",
+    )
+    parser.add_argument(
+        "--recipe-cache",
+        metavar="FILE",
+        help="Load graph recipes from FILE if it exists and save them there at the end",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Never contact the Checkmk site, only use recipes from --recipe-cache."
+        " Stops before converting anything if a recipe is missing",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Prefetch all graph recipes over N parallel connections before converting",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Transform the dashboard JSON in N worker processes",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        metavar="N",
+        help="Read, convert and commit N dashboards at a time (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--single-transaction",
+        action="store_true",
+        help="Commit all dashboards in one transaction instead of once per batch",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Convert all dashboards again, even those the ledger marks as done",
+    )
+    parser.add_argument(
+        "--bundle",
+        metavar="FILE",
+        help="Dry run: write the converted dashboards to FILE (gzipped NDJSON) instead of the database",
+    )
+    parser.add_argument(
+        "--apply-bundle",
+        metavar="FILE",
+        help="Write the dashboards of a bundle created with --bundle in a single transaction",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print phase timings and remote call statistics at the end",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="Write phase timings and remote call statistics as JSON to FILE",
+    )
     return parser
 
 
@@ -77,6 +165,101 @@ def extract_single_info(context):
     }
 
 
+def index_recipes(recipes):
+    # only keep what update_graph needs: (graph_id, title, metrics) per graph
+    # and (metric_name, title) per metric, or None for non rrd metrics
+    return [
+        (
+            recipe["specification"][1].get("graph_id"),
+            recipe["title"],
+            [
+                (
+                    (metric["expression"][4], metric["title"])
+                    if metric["expression"][0] == "rrd"
+                    else None
+                )
+                for metric in recipe["metrics"]
+            ],
+        )
+        for recipe in recipes
+    ]
+
+
+def cache_key(context):
+    return tuple(extract_single_info(context).values())
+
+
+class RecipeCache:
+    def __init__(self, maxsize=RECIPE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._recipes = OrderedDict()
+
+    def __len__(self):
+        return len(self._recipes)
+
+    def __contains__(self, key):
+        return key in self._recipes
+
+    def items(self):
+        return self._recipes.items()
+
+    def get(self, key):
+        recipes = self._recipes.get(key)
+        if recipes is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._recipes.move_to_end(key)
+        return recipes
+
+    def put(self, key, recipes):
+        self._recipes[key] = recipes
+        self._recipes.move_to_end(key)
+        while len(self._recipes) > self.maxsize:
+            self._recipes.popitem(last=False)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            snapshot = json.load(f)
+        for site, host_name, service_description, recipes in snapshot["recipes"]:
+            if recipes and isinstance(recipes[0], dict):
+                # snapshot of raw recipes written by an older converter
+                recipes = index_recipes(recipes)
+            self.put((site, host_name, service_description), recipes)
+
+    def save(self, path):
+        snapshot = {
+            "recipes": [[*key, recipes] for key, recipes in self._recipes.items()]
+        }
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".tmp", path)
+
+    def summary(self):
+        return (
+            f"recipe cache: {self.hits} hits, {self.misses} misses, {len(self)} entries"
+        )
+
+
+def cached(query_graph, cache):
+    def _cached(context):
+        key = cache_key(context)
+        recipes = cache.get(key)
+        if recipes is not None:
+            return recipes
+        if query_graph is None:
+            return []
+        recipes = query_graph(context)
+        cache.put(key, recipes)
+        return recipes
+
+    return _cached
+
+
 def update_graph(query_graph, target):
     mode = target.pop("mode", "")
     metric_id = [int(x) for x in target.pop("metric", "").split(".") if x]
@@ -89,19 +272,15 @@ def update_graph(query_graph, target):
 
     graph = query_graph(target["context"])
     if mode == "graph" and graph_idx < len(graph):
-        graph_name = graph[graph_idx]["specification"][1]["graph_id"]
-        graph_title = graph[graph_idx]["title"]
+        graph_name, graph_title, _metrics = graph[graph_idx]
         config_set(target, ["params", "graph_name"], graph_name, graph_title)
     elif mode == "metric" and len(metric_id) == 2:
         graph_idx, metric_idx = metric_id
-        if graph_idx < len(graph) and metric_idx < len(graph[graph_idx]["metrics"]):
-            metric = graph[graph_idx]["metrics"][metric_idx]
-            expression = metric["expression"]
-            if expression[0] == "rrd":
+        if graph_idx < len(graph) and metric_idx < len(graph[graph_idx][2]):
+            if metric := graph[graph_idx][2][metric_idx]:
+                metric_name, metric_title = metric
                 nested_set(target, ["params", "graphMode"], "metric")
-                config_set(
-                    target, ["params", "graph_name"], expression[4], metric["title"]
-                )
+                config_set(target, ["params", "graph_name"], metric_name, metric_title)
     else:
         config_set(target, ["params", "graph_name"], "", "Not available")
 
@@ -114,69 +293,616 @@ def get_datasource_configs(cursor):
             yield name, {**json.loads(json_data), "name": name, "ds": ds}
 
 
-def query(conf):
-    def _query(context):
-        req = rq.Request(
-            conf["url"]
-            + "/check_mk/webapi.py?_username=%s&_secret=%s&action=get_graph_recipes"
-            % (conf["username"], conf["secret"])
+class ConnectionPool:
+    def __init__(self, url, size=1):
+        parts = urlsplit(url)
+        self.path = parts.path.rstrip("/")
+        self._host = parts.netloc
+        self._connection_class = (
+            HTTPSConnection if parts.scheme == "https" else HTTPConnection
         )
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    def post(self, url, body, headers):
+        connection = self._idle.get() or self._connection_class(self._host)
+        try:
+            # a kept-alive connection may have been closed by the server
+            # meanwhile, so retry once on a fresh one
+            for attempt in range(2):
+                try:
+                    connection.request("POST", url, body, headers)
+                    response = connection.getresponse()
+                    return response.status, response.read()
+                except (HTTPException, ConnectionError):
+                    connection.close()
+                    if attempt:
+                        raise
+        finally:
+            self._idle.put(connection)
+
+    def close(self):
+        while not self._idle.empty():
+            if connection := self._idle.get_nowait():
+                connection.close()
+
+
+def query(conf, pool, stats):
+    url = (
+        pool.path
+        + "/check_mk/webapi.py?_username=%s&_secret=%s&action=get_graph_recipes"
+        % (conf["username"], conf["secret"])
+    )
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    def _query(context):
         spec = {"specification": ["template", extract_single_info(context)]}
-        response = rq.urlopen(req, ("request=%s" % json.dumps(spec)).encode("utf-8"))
-        if response.status == 200:
-            return json.loads(response.read())["result"]
-        return []
+        start = time.perf_counter()
+        status, body = pool.post(
+            url, ("request=%s" % json.dumps(spec)).encode("utf-8"), headers
+        )
+        stats.record_query(time.perf_counter() - start, status, len(body))
+        # redirects are not followed, and no status but 200 carries recipes
+        if status != 200:
+            raise RuntimeError(f"get_graph_recipes failed with HTTP status {status}")
+        return index_recipes(json.loads(body)["result"])
 
     return _query
 
 
-def update_dashboard(data, args, query_graph):
+def collect_contexts(data, datasource_old):
     dash = json.loads(data)
+    for panel in dash["panels"]:
+        if panel.get("datasource") == datasource_old:
+            for target in panel["targets"]:
+                if target.get("combinedgraph"):
+                    continue
+                target = copy.deepcopy(target)
+                update_context(target)
+                yield target["context"]
+
+
+def prefetch(contexts, query_graph, cache, workers):
+    missing = [context for key, context in contexts.items() if key not in cache]
+    if len(contexts) > cache.maxsize:
+        # the prefetched recipes are only useful if none of them is evicted
+        # before the conversion reads it
+        print(
+            f"raising the recipe cache size from {cache.maxsize} to {len(contexts)}"
+            " to hold all prefetched recipes"
+        )
+        cache.maxsize = len(contexts)
+    cache.misses += len(missing)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for context, recipes in zip(missing, executor.map(query_graph, missing)):
+            cache.put(cache_key(context), recipes)
+
+
+def target_kind(target):
+    if target.get("combinedgraph"):
+        return "combinedgraph"
+    if target.get("hostregex") or target.get("serviceregex"):
+        return "regex"
+    return target.get("mode") or "unknown"
+
+
+def update_dashboard(dash, args, query_graph):
+    changed = False
+    changed_targets = Counter()
 
     for panel in dash["panels"]:
         if panel.get("datasource") == args.datasource_old:
             panel["datasource"] = args.datasource_new
+            changed = True
 
             for target in panel["targets"]:
+                changed_targets[target_kind(target)] += 1
                 update_context(target)
                 update_graph(query_graph, target)
 
-    return dash
+    return changed, changed_targets
 
 
-def main():
-    args = cli_options().parse_args()
-    con = sqlite3.connect(args.db_file)
-    cur = con.cursor()
-    datasource_config = dict(get_datasource_configs(cur))
-    query_graph = query(datasource_config[args.datasource_old])
+def datasource_needle(name):
+    # grafana may escape some characters when storing the dashboard json, so
+    # only names which are stored verbatim can be searched for. the empty
+    # needle matches every dashboard.
+    if name.isascii() and name.isprintable() and not set('"\\<>&') & set(name):
+        return json.dumps(name)
+    return ""
+
 
-    for did, data, creator in cur.execute("select id, data, created_by from dashboard"):
-        dash = update_dashboard(data, args, query_graph)
-        version = dash["version"]
-        dash["version"] += 1
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def iter_dashboards(con, batch_size, needle="", start_id=0):
+    # page by id on a separate cursor, so writing the converted dashboards
+    # does not interfere with reading the next ones
+    cur = con.cursor()
+    while True:
         cur.execute(
-            "insert into dashboard_version (dashboard_id, parent_version, restored_from, version,  created, created_by, message, data) values(?,?,?,?,?,?,?,?)",
+            "select id, data, created_by from dashboard"
+            " where id > ? and instr(data, ?) > 0 order by id limit ?",
+            (start_id, needle, batch_size),
+        )
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+        start_id = rows[-1][0]
+
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def create_ledger(con):
+    # one row per dashboard and pair of datasources, a dashboard may contain
+    # panels of several old datasources which are converted one at a time
+    con.execute(f"""CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+        dashboard_id INTEGER NOT NULL,
+        datasource_old TEXT NOT NULL,
+        datasource_new TEXT NOT NULL,
+        result_hash TEXT NOT NULL,
+        converter_version TEXT NOT NULL,
+        converted TEXT NOT NULL,
+        PRIMARY KEY (dashboard_id, datasource_old, datasource_new))""")
+    con.commit()
+
+
+def has_ledger(con):
+    return (
+        con.execute(
+            "select 1 from sqlite_master where type = 'table' and name = ?",
+            (LEDGER_TABLE,),
+        ).fetchone()
+        is not None
+    )
+
+
+def pending_dashboards(con, batch_size, needle, datasources, ledger=True):
+    # skip dashboards which are unchanged since this converter version
+    # converted them for the same pair of datasources
+    for rows in iter_dashboards(con, batch_size, needle):
+        if not ledger:
+            yield rows[-1][0], rows
+            continue
+        ids = [did for did, _data, _creator in rows]
+        converted = dict(
+            con.execute(
+                f"select dashboard_id, result_hash from {LEDGER_TABLE}"
+                " where converter_version = ? and datasource_old = ? and datasource_new = ?"
+                f" and dashboard_id in ({','.join('?' * len(ids))})",
+                (CONVERTER_VERSION, *datasources, *ids),
+            )
+        )
+        yield rows[-1][0], [
+            row
+            for row in rows
+            if row[0] not in converted or converted[row[0]] != content_hash(row[1])
+        ]
+
+
+class Progress:
+    def __init__(self, con):
+        (self._span,) = con.execute("select max(id) from dashboard").fetchone()
+        self._started = time.monotonic()
+        self.converted = 0
+
+    def update(self, last_id, converted):
+        self.converted += converted
+        done = last_id / self._span if self._span else 1.0
+        elapsed = time.monotonic() - self._started
+        eta = elapsed * (1 - done) / done if done else 0
+        print(
+            f"{done:6.1%} up to dashboard id {last_id}, {self.converted} converted,"
+            f" {self.converted / elapsed if elapsed else 0:.1f} dashboards/s,"
+            f" ETA {int(eta) // 60}m{int(eta) % 60:02d}s"
+        )
+
+
+class Stats:
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.dashboards = Counter()
+        self.targets = Counter()
+        self.queries = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.query_time = 0.0
+        self.status_codes = Counter()
+        self.response_bytes = 0
+        self.max_response_bytes = 0
+        self._slowest = []
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def timed(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def record_query(self, seconds, status, size):
+        bucket = next(
+            (i for i, ms in enumerate(LATENCY_BUCKETS_MS) if seconds * 1000 <= ms),
+            len(LATENCY_BUCKETS_MS),
+        )
+        # called from the prefetch threads
+        with self._lock:
+            self.queries[bucket] += 1
+            self.query_time += seconds
+            self.status_codes[status] += 1
+            self.response_bytes += size
+            self.max_response_bytes = max(self.max_response_bytes, size)
+
+    def record_dashboard(self, did, seconds, changed_targets):
+        self.dashboards["scanned"] += 1
+        self.targets.update(changed_targets)
+        entry = (seconds, did, sum(changed_targets.values()))
+        if len(self._slowest) < SLOWEST_DASHBOARDS:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    def as_dict(self, cache):
+        labels = [f"<={ms}ms" for ms in LATENCY_BUCKETS_MS] + [
+            f">{LATENCY_BUCKETS_MS[-1]}ms"
+        ]
+        return {
+            "wall_time": time.perf_counter() - self._started,
+            "phases": dict(self.phases),
+            "dashboards": dict(self.dashboards),
+            "targets": dict(self.targets),
+            "queries": {
+                "count": sum(self.queries),
+                "time": self.query_time,
+                "latency": dict(zip(labels, self.queries)),
+                "status_codes": {str(k): v for k, v in self.status_codes.items()},
+                "response_bytes": self.response_bytes,
+                "max_response_bytes": self.max_response_bytes,
+            },
+            "recipe_cache": {
+                "hits": cache.hits,
+                "misses": cache.misses,
+                "entries": len(cache),
+            },
+            "slowest_dashboards": [
+                {"id": did, "time": seconds, "targets": targets}
+                for seconds, did, targets in sorted(self._slowest, reverse=True)
+            ],
+        }
+
+
+def transform_dashboard(data, args, query_graph, stats=None):
+    # the phases can only be timed in this process, process pool workers
+    # only report the total time per dashboard
+    phase = stats.phase if stats else lambda _name: contextlib.nullcontext()
+    start = time.perf_counter()
+    with phase("decode"):
+        dash = json.loads(data)
+    with phase("update"):
+        changed, changed_targets = update_dashboard(dash, args, query_graph)
+    if not changed:
+        return None, None, changed_targets, time.perf_counter() - start
+    version = dash["version"]
+    dash["version"] += 1
+    with phase("encode"):
+        new_data = json.dumps(dash)
+    return version, new_data, changed_targets, time.perf_counter() - start
+
+
+_worker_recipes = {}
+
+
+def _init_worker(recipes):
+    global _worker_recipes
+    _worker_recipes = recipes
+
+
+def _collect_job(job):
+    data, datasource_old = job
+    return list(collect_contexts(data, datasource_old))
+
+
+def _transform_job(job):
+    data, args, recipes = job
+    if recipes is None:
+        recipes = _worker_recipes
+    return transform_dashboard(
+        data, args, lambda context: recipes.get(cache_key(context), [])
+    )
+
+
+def transform_parallel(executor, rows, args, query_graph, prefetched):
+    datas = [data for _did, data, _creator in rows]
+    chunksize = max(1, len(datas) // (args.processes * 4))
+    if prefetched:
+        recipes = [None] * len(datas)
+    else:
+        # the workers find the contexts, but only this process talks to checkmk
+        recipes = [
+            {cache_key(context): query_graph(context) for context in contexts}
+            for contexts in executor.map(
+                _collect_job,
+                [(data, args.datasource_old) for data in datas],
+                chunksize=chunksize,
+            )
+        ]
+    return executor.map(
+        _transform_job,
+        [(data, args, r) for data, r in zip(datas, recipes)],
+        chunksize=chunksize,
+    )
+
+
+def convert_batch(rows, transformed, stats):
+    records = []
+    for (did, data, creator), (version, new_data, changed_targets, seconds) in zip(
+        rows, transformed
+    ):
+        stats.record_dashboard(did, seconds, changed_targets)
+        records.append(
+            (
+                did,
+                creator,
+                content_hash(data),
+                version,
+                new_data,
+                sum(changed_targets.values()),
+            )
+        )
+    return records
+
+
+def batch_rows(records, datasources):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    versions = []
+    updates = []
+    ledger = []
+    for did, creator, source_hash, version, new_data, _changed_targets in records:
+        if new_data is None:
+            ledger.append((did, *datasources, source_hash, CONVERTER_VERSION, now))
+            continue
+        ledger.append(
+            (did, *datasources, content_hash(new_data), CONVERTER_VERSION, now)
+        )
+        versions.append(
             (
                 did,
                 version,
                 0,
-                dash["version"],
+                version + 1,
                 now,
                 creator,
                 "Checkmk connector update",
-                json.dumps(dash),
-            ),
+                new_data,
+            )
         )
-        cur.execute(
-            """UPDATE dashboard SET
-            data = ?, version = ?, updated = ?
-            WHERE id = ?""",
-            (json.dumps(dash), dash["version"], now, did),
+        updates.append((new_data, version + 1, now, did))
+    return versions, updates, ledger
+
+
+def write_batch(con, versions, updates, ledger):
+    con.executemany(
+        "insert into dashboard_version (dashboard_id, parent_version, restored_from, version,  created, created_by, message, data) values(?,?,?,?,?,?,?,?)",
+        versions,
+    )
+    con.executemany(
+        """UPDATE dashboard SET
+        data = ?, version = ?, updated = ?
+        WHERE id = ?""",
+        updates,
+    )
+    con.executemany(
+        f"insert or replace into {LEDGER_TABLE} (dashboard_id, datasource_old, datasource_new, result_hash, converter_version, converted) values(?,?,?,?,?,?)",
+        ledger,
+    )
+
+
+def write_bundle(bundle, records, datasources):
+    for did, creator, source_hash, version, new_data, changed_targets in records:
+        if new_data is None:
+            continue
+        bundle.write(
+            json.dumps(
+                {
+                    "id": did,
+                    "datasources": datasources,
+                    "version": version,
+                    "created_by": creator,
+                    "source_hash": source_hash,
+                    "changed_targets": changed_targets,
+                    "data": new_data,
+                }
+            )
+            + "\n"
+        )
+
+
+def read_bundle(bundle, batch_size):
+    # a bundle is written by a single run, so all entries share the datasources
+    datasources = None
+    records = []
+    for line in bundle:
+        entry = json.loads(line)
+        datasources = tuple(entry["datasources"])
+        records.append(
+            (
+                entry["id"],
+                entry["created_by"],
+                entry["source_hash"],
+                entry["version"],
+                entry["data"],
+                entry["changed_targets"],
+            )
         )
-        con.commit()
+        if len(records) == batch_size:
+            yield datasources, records
+            records = []
+    if records:
+        yield datasources, records
+
+
+def apply_bundle(args):
+    con = sqlite3.connect(args.db_file)
+    create_ledger(con)
+    applied = 0
+    with gzip.open(args.apply_bundle, "rt", encoding="utf-8") as bundle:
+        for datasources, records in read_bundle(bundle, args.batch_size):
+            ids = [record[0] for record in records]
+            versions = dict(
+                con.execute(
+                    f"select id, version from dashboard where id in ({','.join('?' * len(ids))})",
+                    ids,
+                )
+            )
+            # dashboards saved since the bundle was created must be converted again
+            for record in records:
+                if versions.get(record[0]) != record[3]:
+                    print(
+                        f"skipping dashboard id {record[0]}: changed since the dry run"
+                    )
+            records = [r for r in records if versions.get(r[0]) == r[3]]
+            write_batch(con, *batch_rows(records, datasources))
+            applied += len(records)
+    con.commit()
+    con.close()
+    print(f"applied {applied} dashboards")
+
+
+def scan_contexts(con, args, needle, datasources, ledger, stats):
+    contexts = {}
+    for _last_id, rows in stats.timed(
+        "read",
+        pending_dashboards(con, args.batch_size, needle, datasources, ledger),
+    ):
+        with stats.phase("prefetch_scan"):
+            for _did, data, _creator in rows:
+                for context in collect_contexts(data, args.datasource_old):
+                    contexts.setdefault(cache_key(context), context)
+    return contexts
+
+
+def main(argv=None):
+    parser = cli_options()
+    args = parser.parse_args(argv)
+    if args.offline and not args.recipe_cache:
+        parser.error("--offline requires --recipe-cache")
+    if args.apply_bundle:
+        apply_bundle(args)
+        return
+
+    if args.bundle:
+        con = sqlite3.connect(f"file:{args.db_file}?mode=ro", uri=True)
+    else:
+        con = sqlite3.connect(args.db_file)
+    cur = con.cursor()
+    datasource_config = dict(get_datasource_configs(cur))
+    cache = RecipeCache(args.cache_size)
+    if args.recipe_cache:
+        cache.load(args.recipe_cache)
+    stats = Stats()
+    pool = None
+    query_remote = None
+    if not args.offline:
+        conf = datasource_config[args.datasource_old]
+        pool = ConnectionPool(conf["url"], max(args.workers, 1))
+        query_remote = query(conf, pool, stats)
+
+    needle = datasource_needle(args.datasource_old)
+    if not args.bundle:
+        create_ledger(con)
+    ledger = has_ledger(con) and not args.restart
+    datasources = (args.datasource_old, args.datasource_new)
+
+    if args.offline:
+        # without the site a missing recipe would be converted to a wrong
+        # graph and recorded as done in the ledger
+        contexts = scan_contexts(con, args, needle, datasources, ledger, stats)
+        missing = sum(1 for key in contexts if key not in cache)
+        if missing:
+            sys.exit(
+                f"{missing} of {len(contexts)} graph recipes are missing in"
+                f" {args.recipe_cache}, run without --offline to fetch them"
+            )
+
+    prefetched = bool(args.workers and query_remote)
+    if prefetched:
+        contexts = scan_contexts(con, args, needle, datasources, ledger, stats)
+        with stats.phase("prefetch"):
+            prefetch(contexts, query_remote, cache, args.workers)
+
+    query_graph = cached(query_remote, cache)
+
+    executor = None
+    if args.processes:
+        executor = ProcessPoolExecutor(
+            args.processes,
+            initializer=_init_worker,
+            initargs=(dict(cache.items()) if prefetched else {},),
+        )
+
+    bundle = None
+    if args.bundle:
+        bundle = gzip.open(args.bundle, "wt", encoding="utf-8")
+
+    progress = Progress(con)
+    for last_id, rows in stats.timed(
+        "read", pending_dashboards(con, args.batch_size, needle, datasources, ledger)
+    ):
+        if executor:
+            with stats.phase("transform"):
+                transformed = list(
+                    transform_parallel(executor, rows, args, query_graph, prefetched)
+                )
+        else:
+            transformed = [
+                transform_dashboard(data, args, query_graph, stats)
+                for _did, data, _creator in rows
+            ]
+        with stats.phase("write"):
+            records = convert_batch(rows, transformed, stats)
+            if bundle:
+                write_bundle(bundle, records, datasources)
+            else:
+                write_batch(con, *batch_rows(records, datasources))
+        converted = sum(1 for record in records if record[4] is not None)
+        stats.dashboards["converted"] += converted
+        if not args.single_transaction and not bundle:
+            with stats.phase("commit"):
+                con.commit()
+        progress.update(last_id, converted)
+    if bundle:
+        bundle.close()
+    else:
+        with stats.phase("commit"):
+            con.commit()
     con.close()
+    if executor:
+        executor.shutdown()
+    if pool:
+        pool.close()
+
+    if args.recipe_cache:
+        cache.save(args.recipe_cache)
+    print(cache.summary())
+
+    report = stats.as_dict(cache)
+    if args.profile:
+        print(json.dumps(report, indent=2))
+    if args.stats_json:
+        with open(args.stats_json, "w") as f:
+            json.dump(report, f, indent=2)
 
 
 if __name__ == "__main__":
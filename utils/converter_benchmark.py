@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import converter
+
+DATASOURCE_OLD = "checkmk-1.x"
+DATASOURCE_NEW = "checkmk-2.x"
+
+
+def cli_options():
+    parser = argparse.ArgumentParser(
+        description="Benchmark converter.py against a synthetic Grafana database",
+        epilog="Arguments after -- are passed on to converter.py",
+    )
+    parser.add_argument("--dashboards", type=int, default=1000)
+    parser.add_argument("--panels", type=int, default=10, help="per dashboard")
+    parser.add_argument("--targets", type=int, default=2, help="per panel")
+    parser.add_argument("--hosts", type=int, default=100)
+    parser.add_argument("--services", type=int, default=20, help="per host")
+    parser.add_argument(
+        "--graphs", type=int, default=3, help="graph recipes per service"
+    )
+    parser.add_argument(
+        "--metrics", type=int, default=4, help="metrics per graph recipe"
+    )
+    parser.add_argument(
+        "--foreign",
+        type=float,
+        default=0.5,
+        help="share of dashboards which use another datasource (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="latency of the webapi stub in milliseconds",
+    )
+    parser.add_argument("--seed", default="converter-benchmark")
+    parser.add_argument(
+        "--db-file",
+        help="keep the generated database at this path instead, it must not exist yet",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="show the converter output"
+    )
+    return parser
+
+
+def random_target(rnd, args):
+    host = f"host{rnd.randrange(args.hosts):05d}"
+    service = f"Service {rnd.randrange(args.services):03d}"
+    target = {
+        "context": {},
+        "refId": "A",
+        "site": rnd.choice(["", "cmk"]),
+        "filter0group": "",
+        "filter0op": "is",
+        "filter0value": rnd.choice(["", "", "lnx", "win"]),
+        "format": "time_series",
+        "usehostregex": False,
+    }
+    kind = rnd.random()
+    if kind < 0.4:
+        target.update(
+            host=host, service=service, mode="graph", graph=rnd.randrange(args.graphs)
+        )
+    elif kind < 0.8:
+        target.update(
+            host=host,
+            service=service,
+            mode="metric",
+            metric=f"{rnd.randrange(args.graphs)}.{rnd.randrange(args.metrics)}",
+        )
+    else:
+        target.update(
+            usehostregex=True,
+            hostregex=f"^host{rnd.randrange(10)}",
+            serviceregex="^Service",
+            mode="combined",
+            combinedgraph=f"graph_{rnd.randrange(args.graphs)}",
+            presentation=rnd.choice(["lines", "stacked", "sum", "average"]),
+        )
+    return target
+
+
+def random_dashboard(rnd, args, uid):
+    datasource = "prometheus" if rnd.random() < args.foreign else DATASOURCE_OLD
+    return {
+        "uid": uid,
+        "title": f"Dashboard {uid}",
+        "version": 1,
+        "schemaVersion": 16,
+        "panels": [
+            {
+                "id": panel_id,
+                "type": "graph",
+                "title": f"Panel {panel_id}",
+                "datasource": datasource,
+                "gridPos": {"h": 8, "w": 12, "x": 0, "y": 8 * panel_id},
+                "targets": [random_target(rnd, args) for _ in range(args.targets)],
+            }
+            for panel_id in range(args.panels)
+        ],
+    }
+
+
+def generate_db(path, args, url):
+    rnd = random.Random(args.seed)
+    con = sqlite3.connect(path)
+    con.executescript("""
+        CREATE TABLE data_source (
+            id INTEGER PRIMARY KEY, org_id INTEGER, version INTEGER,
+            type TEXT, name TEXT, url TEXT, json_data TEXT);
+        CREATE TABLE dashboard (
+            id INTEGER PRIMARY KEY, version INTEGER, slug TEXT, title TEXT,
+            data TEXT, org_id INTEGER, created TEXT, updated TEXT,
+            created_by INTEGER, updated_by INTEGER, uid TEXT);
+        CREATE TABLE dashboard_version (
+            id INTEGER PRIMARY KEY, dashboard_id INTEGER, parent_version INTEGER,
+            restored_from INTEGER, version INTEGER, created TEXT,
+            created_by INTEGER, message TEXT, data TEXT);
+        """)
+    con.execute(
+        "insert into data_source (org_id, version, type, name, url, json_data) values (1, 1, ?, ?, ?, ?)",
+        (
+            "checkmk-datasource",
+            DATASOURCE_OLD,
+            url,
+            json.dumps({"url": url, "username": "automation", "secret": "secret"}),
+        ),
+    )
+    now = "2022-01-01 00:00:00"
+    con.executemany(
+        "insert into dashboard (version, slug, title, data, org_id, created, updated, created_by, updated_by, uid) values (1, ?, ?, ?, 1, ?, ?, 1, 1, ?)",
+        (
+            (
+                f"dashboard-{uid}",
+                f"Dashboard {uid}",
+                json.dumps(random_dashboard(rnd, args, uid)),
+                now,
+                now,
+                uid,
+            )
+            for uid in map(str, range(args.dashboards))
+        ),
+    )
+    con.commit()
+    con.close()
+
+
+def graph_recipes(args, info):
+    return [
+        {
+            "title": f"Graph {graph} of {info['service_description']}",
+            "specification": ["template", {**info, "graph_id": f"graph_{graph}"}],
+            "metrics": [
+                {
+                    "title": f"Metric {metric}",
+                    "expression": [
+                        "rrd",
+                        info["site"],
+                        info["host_name"],
+                        info["service_description"],
+                        f"metric_{graph}_{metric}",
+                        "max",
+                        1,
+                    ],
+                }
+                for metric in range(args.metrics)
+            ],
+        }
+        for graph in range(args.graphs)
+    ]
+
+
+class WebApiStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, args):
+        super().__init__(("127.0.0.1", 0), WebApiHandler)
+        self.args = args
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class WebApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server._lock:
+            self.server.calls += 1
+        time.sleep(self.server.args.latency / 1000)
+        if "action=get_graph_recipes" not in self.path:
+            self.send_error(404)
+            return
+        spec = json.loads(parse_qs(request.decode("utf-8"))["request"][0])
+        body = json.dumps(
+            {
+                "result_code": 0,
+                "result": graph_recipes(self.server.args, spec["specification"][1]),
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TimedConnection(sqlite3.Connection):
+    commit_time = 0.0
+
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        TimedConnection.commit_time += time.perf_counter() - start
+
+
+def run_converter(argv, verbose, result):
+    connect = sqlite3.connect
+    converter.sqlite3.connect = lambda *a, **kw: connect(
+        *a, factory=TimedConnection, **kw
+    )
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+        start = time.perf_counter()
+        converter.main(argv)
+        wall_time = time.perf_counter() - start
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    result.send(
+        {
+            "wall_time": wall_time,
+            "commit_time": TimedConnection.commit_time,
+            "peak_rss_mb": rss / 1024,
+        }
+    )
+
+
+def main():
+    argv = sys.argv[1:]
+    converter_argv = []
+    if "--" in argv:
+        converter_argv = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+    parser = cli_options()
+    args = parser.parse_args(argv)
+    if args.db_file and os.path.exists(args.db_file):
+        parser.error(f"--db-file {args.db_file} already exists")
+
+    stub = WebApiStub(args)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = args.db_file or os.path.join(tmp, "grafana.db")
+        start = time.perf_counter()
+        generate_db(db_file, args, stub.url)
+        generate_time = time.perf_counter() - start
+
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.get_context("fork").Process(
+            target=run_converter,
+            args=(
+                [
+                    "--db-file",
+                    db_file,
+                    "--datasource-old",
+                    DATASOURCE_OLD,
+                    "--datasource-new",
+                    DATASOURCE_NEW,
+                    *converter_argv,
+                ],
+                args.verbose,
+                sender,
+            ),
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            sys.exit(f"converter failed with exit code {process.exitcode}")
+        result = receiver.recv()
+
+        con = sqlite3.connect(db_file)
+        (converted,) = con.execute("select count(*) from dashboard_version").fetchone()
+        con.close()
+
+    stub.shutdown()
+    report = {
+        "dashboards": args.dashboards,
+        "converted": converted,
+        "generate_time": generate_time,
+        **result,
+        "dashboards_per_second": args.dashboards / result["wall_time"],
+        "remote_calls": stub.calls,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(
+            f"{key:>22}: {value:.2f}"
+            if isinstance(value, float)
+            else f"{key:>22}: {value}"
+        )
+
+
+if __name__ == "__main__":
+    main()
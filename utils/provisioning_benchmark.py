@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import contextlib
+import importlib.util
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+POST_START = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "tests",
+    "checkmk-docker-hooks",
+    "post-start",
+)
+sys.path.insert(0, POST_START)
+_spec = importlib.util.spec_from_file_location(
+    "post_configure_checkmk", os.path.join(POST_START, "post-configure-checkmk.py")
+)
+post_configure_checkmk = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(post_configure_checkmk)
+
+import generate_agent_outputs
+
+API_PREFIX = "/cmk/check_mk/api/v1"
+
+
+def cli_options():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the provisioning of post-configure-checkmk.py"
+        " against a local stand-in of the Checkmk REST API",
+    )
+    parser.add_argument(
+        "--hosts",
+        default="10,1000,10000",
+        help="comma separated numbers of hosts to create (default: %(default)s)",
+    )
+    parser.add_argument("--services", type=int, default=20, help="per host")
+    parser.add_argument(
+        "--version", default="2.3.0p30", help="Checkmk version of the stub"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="latency of every request in milliseconds",
+    )
+    parser.add_argument(
+        "--create-time",
+        type=float,
+        default=0.0,
+        help="milliseconds per host of a bulk-create request",
+    )
+    parser.add_argument(
+        "--discovery-time",
+        type=float,
+        default=1.0,
+        help="milliseconds per host of a discovery job (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--activation-time",
+        type=float,
+        default=500.0,
+        help="milliseconds of an activation job (default: %(default)s)",
+    )
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--parallel-chunks", type=int)
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="provision with reconcile_from, and once more on the unchanged site",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="show the provisioning output"
+    )
+    return parser
+
+
+class Job:
+    def __init__(self, duration, hosts=()):
+        self.started = time.monotonic()
+        self.duration = duration
+        self.hosts = list(hosts)
+
+    @property
+    def done(self):
+        return min(1.0, (time.monotonic() - self.started) / (self.duration or 1e-9))
+
+
+class RestApiStub(ThreadingHTTPServer):
+    """
+    keeps just enough state of a site to answer the requests of the API class
+    """
+
+    daemon_threads = True
+
+    def __init__(self, args):
+        super().__init__(("127.0.0.1", 0), RestApiHandler)
+        self.args = args
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests.clear()
+        self.folders = {}
+        self.rules = {}
+        self.hosts = {}
+        self.users = {}
+        self.jobs = {}
+        self.changes = []
+        self.ids = itertools.count()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def le_230(self):
+        return bool(re.match("^(2.3.0|2.2.0|2.1.0|2.0.0)", self.args.version))
+
+    def change(self, text):
+        self.changes.append({"user_id": "cmkadmin", "text": text})
+
+
+class RestApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        url = urlsplit(self.path)
+        path = url.path.removeprefix(API_PREFIX)
+        time.sleep(server.args.latency / 1000)
+        for pattern, handler in ROUTES[method]:
+            if match := re.fullmatch(pattern, path):
+                with server.lock:
+                    server.requests[f"{method} {pattern}"] += 1
+                    if not self._authorized():
+                        return self._send(401, {"title": "Unauthorized"})
+                    status, response = handler(
+                        server, body, parse_qs(url.query), *match.groups()
+                    )
+                # slow requests do not block the other requests
+                if method == "POST" and "bulk-create" in path:
+                    time.sleep(server.args.create_time * len(body["entries"]) / 1000)
+                return self._send(status, response)
+        with server.lock:
+            server.requests[f"{method} unknown"] += 1
+        self._send(404, {"title": f"no stub for {method} {path}"})
+
+    def _authorized(self):
+        _bearer, username, secret = self.headers["Authorization"].split(" ", 2)
+        if username == post_configure_checkmk.CMK_ADMIN:
+            return secret == post_configure_checkmk.CMK_PASS
+        return self.server.users.get(username) == secret
+
+    def _send(self, status, response):
+        body = b"" if response is None else json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def self_link(server, path):
+    return [
+        {"rel": "self", "href": f"http://localhost:{server.port}{API_PREFIX}{path}"}
+    ]
+
+
+def version(server, body, query):
+    return 200, {"versions": {"checkmk": server.args.version}}
+
+
+def create_folder(server, body, query):
+    server.folders[body["name"]] = body["title"]
+    server.change(f"Created folder {body['name']}")
+    return 200, {"id": body["name"], "title": body["title"]}
+
+
+def get_folder(server, body, query, name):
+    if name not in server.folders:
+        return 404, {"title": "Not Found"}
+    return 200, {"id": name, "title": server.folders[name]}
+
+
+def delete_folder(server, body, query, name):
+    if server.folders.pop(name, None) is None:
+        return 404, {"title": "Not Found"}
+    server.hosts = {h: f for h, f in server.hosts.items() if f != name}
+    server.rules = {i: r for i, r in server.rules.items() if r["folder"] != name}
+    server.change(f"Deleted folder {name}")
+    return 204, None
+
+
+def folder_hosts(server, body, query, name):
+    return 200, {
+        "value": [
+            {"id": host} for host, folder in server.hosts.items() if folder == name
+        ]
+    }
+
+
+def create_rule(server, body, query):
+    rule_id = str(next(server.ids))
+    server.rules[rule_id] = {
+        "ruleset": body["ruleset"],
+        "folder": body["folder"].lstrip("~"),
+        "value_raw": body["value_raw"],
+    }
+    server.change(f"Created rule {rule_id}")
+    return 200, {"id": rule_id}
+
+
+def get_rules(server, body, query):
+    ruleset = query.get("ruleset_name", [""])[0]
+    return 200, {
+        "value": [
+            {
+                "id": rule_id,
+                "extensions": {
+                    "folder": f"/{rule['folder']}",
+                    "value_raw": rule["value_raw"],
+                },
+            }
+            for rule_id, rule in server.rules.items()
+            if rule["ruleset"] == ruleset
+        ]
+    }
+
+
+def delete_rule(server, body, query, rule_id):
+    if server.rules.pop(rule_id, None) is None:
+        return 404, {"title": "Not Found"}
+    server.change(f"Deleted rule {rule_id}")
+    return 204, None
+
+
+def bulk_create(server, body, query):
+    existing = [
+        e["host_name"] for e in body["entries"] if e["host_name"] in server.hosts
+    ]
+    if existing:
+        return 400, {"title": f"hosts already exist: {', '.join(existing)}"}
+    for entry in body["entries"]:
+        server.hosts[entry["host_name"]] = entry["folder"].lstrip("~")
+    server.change(f"Created {len(body['entries'])} hosts")
+    return 200, {"value": [{"id": e["host_name"]} for e in body["entries"]]}
+
+
+def bulk_delete(server, body, query):
+    for host in body["entries"]:
+        server.hosts.pop(host, None)
+    server.change(f"Deleted {len(body['entries'])} hosts")
+    return 204, None
+
+
+def start_discovery(server, body, query):
+    if any(job.done < 1 for job in server.jobs.values() if job.hosts):
+        return 409, {"title": "A bulk discovery job is already running"}
+    job_id = f"discovery-{next(server.ids)}"
+    hosts = body["hostnames"]
+    server.jobs[job_id] = Job(len(hosts) * server.args.discovery_time / 1000, hosts)
+    server.change(f"Discovered {len(hosts)} hosts")
+    return 200, {
+        "title": f"Bulk discovery of {len(hosts)} hosts started",
+        "extensions": {"active": True},
+        "links": self_link(server, f"/objects/discovery_run/{job_id}"),
+    }
+
+
+def write_autochecks(hosts):
+    # reconcile_from rediscovers hosts without discovered services
+    folder = os.path.expanduser(
+        os.path.join("~", post_configure_checkmk.AUTOCHECKS_DIR)
+    )
+    os.makedirs(folder, exist_ok=True)
+    for host in hosts:
+        with open(os.path.join(folder, f"{host}.mk"), "w") as f:
+            f.write("[\n  {'check_plugin_name': 'local', 'item': 'stub'},\n]\n")
+
+
+def get_discovery(server, body, query, job_id):
+    job = server.jobs[job_id]
+    done = job.done
+    if done == 1:
+        write_autochecks(job.hosts)
+    progress = [f"Processed {host}" for host in job.hosts[: int(len(job.hosts) * done)]]
+    result = ["Bulk discovery successful"] if done == 1 else []
+    state = "finished" if done == 1 else "running"
+    if server.le_230:
+        extensions = {"logs": {"progress": progress, "result": result}, "state": state}
+    else:
+        extensions = {
+            "status": {
+                "state": state,
+                "log_info": {"JobProgressUpdate": progress, "JobResult": result},
+            }
+        }
+    return 200, {"title": f"Bulk discovery {state}", "extensions": extensions}
+
+
+def activate(server, body, query):
+    if not server.changes:
+        return 422, {"title": "There are no changes to be activated."}
+    job_id = f"activation-{next(server.ids)}"
+    server.jobs[job_id] = Job(server.args.activation_time / 1000)
+    server.jobs[job_id].changes = server.changes
+    server.changes = []
+    return 200, {
+        "title": "Activation started",
+        "links": self_link(server, f"/objects/activation_run/{job_id}"),
+    }
+
+
+def get_activation(server, body, query, job_id):
+    job = server.jobs[job_id]
+    running = job.done < 1
+    return 200, {
+        "title": "Activation is running." if running else "Activation has completed.",
+        "extensions": {"is_running": running, "changes": job.changes},
+    }
+
+
+def create_user(server, body, query):
+    server.users[body["username"]] = body["auth_option"]["secret"]
+    server.change(f"Created user {body['username']}")
+    return 200, {"id": body["username"]}
+
+
+def get_user(server, body, query, name):
+    if name not in server.users:
+        return 404, {"title": "Not Found"}
+    return 200, {"id": name}
+
+
+def delete_user(server, body, query, name):
+    if server.users.pop(name, None) is None:
+        return 404, {"title": "Not Found"}
+    server.change(f"Deleted user {name}")
+    return 204, None
+
+
+ROUTES = {
+    "GET": [
+        ("/version", version),
+        (r"/objects/folder_config/~(\w+)/collections/hosts", folder_hosts),
+        (r"/objects/folder_config/~(\w+)", get_folder),
+        ("/domain-types/rule/collections/all", get_rules),
+        (r"/objects/discovery_run/([\w-]+)", get_discovery),
+        (r"/objects/activation_run/([\w-]+)", get_activation),
+        (r"/objects/user_config/(\w+)", get_user),
+    ],
+    "POST": [
+        ("/domain-types/folder_config/collections/all", create_folder),
+        ("/domain-types/rule/collections/all", create_rule),
+        ("/domain-types/host_config/actions/bulk-create/invoke", bulk_create),
+        ("/domain-types/host_config/actions/bulk-delete/invoke", bulk_delete),
+        (
+            "/domain-types/discovery_run/actions/bulk-discovery-start/invoke",
+            start_discovery,
+        ),
+        (
+            "/domain-types/activation_run/actions/activate-changes/invoke",
+            activate,
+        ),
+        ("/domain-types/user_config/collections/all", create_user),
+    ],
+    "DELETE": [
+        (r"/objects/folder_config/~(\w+)", delete_folder),
+        (r"/objects/rule/(\w+)", delete_rule),
+        (r"/objects/user_config/(\w+)", delete_user),
+    ],
+}
+
+
+def provision(args, stub, hosts):
+    api_options = {
+        key: value
+        for key, value in [
+            ("chunk_size", args.chunk_size),
+            ("parallel_chunks", args.parallel_chunks),
+        ]
+        if value is not None
+    }
+    pc = post_configure_checkmk
+    site = pc.Site(pc.CMK_SITE, True)
+    api = pc.API(site, pipeline=args.pipeline, **api_options)
+    config = pc.CreateConfig(
+        folder_name="grafana",
+        folder_title="grafana",
+        rule_name="datasource_programs",
+        rule_value="'cat ~/var/check_mk/agent_output/$HOSTNAME$'",
+        source_folder="agent_output",
+        host_attributes={"tag_agent": "cmk-agent"},
+        source_destination="~/var/check_mk/agent_output/{host_name}",
+    )
+    source_files = pc.synthetic_files(
+        generate_agent_outputs.Fixture(hosts=hosts, services=args.services)
+    )
+    printer = pc.Printer(0 if args.verbose else -1)
+    provision_from = pc.reconcile_from if args.reconcile else pc.create_from
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            # errors are still printed to stderr
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+        start = time.perf_counter()
+        provision_from(config, source_files, api, site, printer)
+        return time.perf_counter() - start
+
+
+def run(args, stub, hosts):
+    stub.reset()
+    with tempfile.TemporaryDirectory() as home:
+        os.environ["HOME"] = home
+        result = {"hosts": hosts, "wall_time": provision(args, stub, hosts)}
+        result["hosts_per_second"] = hosts / result["wall_time"]
+        result["requests"] = sum(stub.requests.values())
+        result["requests_by_endpoint"] = dict(stub.requests)
+        if args.reconcile:
+            stub.requests.clear()
+            result["rerun_wall_time"] = provision(args, stub, hosts)
+            result["rerun_requests"] = sum(stub.requests.values())
+    if len(stub.hosts) != hosts:
+        sys.exit(f"stub has {len(stub.hosts)} hosts instead of {hosts}")
+    return result
+
+
+def main():
+    args = cli_options().parse_args()
+
+    stub = RestApiStub(args)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    post_configure_checkmk.CMK_PORT = stub.port
+
+    home = os.environ.get("HOME")
+    try:
+        results = [run(args, stub, int(hosts)) for hosts in args.hosts.split(",")]
+    finally:
+        if home is not None:
+            os.environ["HOME"] = home
+    stub.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"{result['hosts']} hosts")
+        for key, value in result.items():
+            if key == "requests_by_endpoint":
+                for endpoint, count in sorted(value.items()):
+                    print(f"{'':>24}{count:>7} {endpoint}")
+                continue
+            print(
+                f"{key:>22}: {value:.2f}"
+                if isinstance(value, float)
+                else f"{key:>22}: {value}"
+            )
+
+
+if __name__ == "__main__":
+    main()